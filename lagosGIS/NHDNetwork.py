@@ -7,12 +7,122 @@
 
 import os
 import re
+import sys
 from collections import defaultdict
+from itertools import chain
 
 import arcpy
+import numpy as np
 from arcpy import management as DM
 
 import lagosGIS
+from lagosGIS import _trace_kernels
+
+TRACE_CACHE_IDS = 2000000 # maximum total identifiers held across all flowline and waterbody traces memoized
+LABEL_CHUNK_SIZE = 1024 # number of sources labeled together in one pass of a multi-source trace
+# connectivity class keyed on (has upstream << 2) | (has downstream << 1) | (has 10ha+ lake upstream)
+CONNECTIVITY_CLASSES = {0b000: 'Isolated', 0b010: 'Headwater', 0b100: 'Terminal', 0b101: 'TerminalLk',
+                        0b110: 'Drainage', 0b111: 'DrainageLk'}
+
+
+def _build_csr(targets, sources, node_count):
+    """
+    Convert an edge list into compressed sparse row (CSR) adjacency arrays, keyed on the target node.
+    :param numpy.ndarray targets: Integer index of the node each edge is grouped under
+    :param numpy.ndarray sources: Integer index of the neighbor node for each edge, same length as targets
+    :param int node_count: Total number of nodes in the network index
+    :return: Tuple of (indptr, indices) int32 arrays. Neighbors of node i are indices[indptr[i]:indptr[i + 1]].
+    """
+    order = np.argsort(targets, kind='stable')  # stable keeps table order within each node's neighbors
+    indices = sources[order].astype(np.int32)
+    indptr = np.zeros(node_count + 1, dtype=np.int32)
+    np.cumsum(np.bincount(targets, minlength=node_count), out=indptr[1:])
+    return indptr, indices
+
+
+def _read_flow_once(flow, from_column, to_column):
+    """
+    Read the flow table edge list into memory.
+    :param str flow: Path to the NHDPlusFlow table
+    :param str from_column: Name of the flow source field
+    :param str to_column: Name of the flow destination field
+    :return: Tuple of (from_ids, to_ids) string arrays, one entry per flow table row
+    """
+    flow_array = arcpy.da.TableToNumPyArray(flow, [from_column, to_column])
+    return flow_array[from_column], flow_array[to_column]
+
+
+def _gather_csr(indptr, indices, rows):
+    """
+    Collect the neighbors of many CSR rows at once, without looping over the rows in Python.
+    :param numpy.ndarray indptr: CSR row pointer array
+    :param numpy.ndarray indices: CSR neighbor array
+    :param numpy.ndarray rows: Integer node indices to collect neighbors for
+    :return: Array of neighbor node indices (with duplicates if rows share neighbors)
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return indices[offsets]
+
+
+def _strong_components(indptr, indices):
+    """
+    Label the strongly connected components of a CSR graph with an iterative version of Tarjan's algorithm.
+    Components are numbered in reverse topological order, so for any edge u -> v between two different components,
+    comp[u] > comp[v].
+    :param numpy.ndarray indptr: CSR row pointer array
+    :param numpy.ndarray indices: CSR neighbor array
+    :return: Tuple of (comp, component_count), where comp is an int32 array with the component number of each node
+    """
+    node_count = len(indptr) - 1
+    indptr = indptr.tolist()
+    indices = indices.tolist()
+    index = [-1] * node_count
+    low = [0] * node_count
+    on_stack = [False] * node_count
+    comp = [-1] * node_count
+    stack = []
+    counter = 0
+    component_count = 0
+
+    for root in range(node_count):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [[root, indptr[root]]]
+        while work:
+            frame = work[-1]
+            v, ptr = frame
+            # visit the next neighbor of v
+            if ptr < indptr[v + 1]:
+                frame[1] += 1
+                w = indices[ptr]
+                if index[w] == -1:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append([w, indptr[w]])
+                elif on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+            # all neighbors done, close v and pop its component if it is a root
+            else:
+                work.pop()
+                if work and low[v] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[v]
+                if low[v] == index[v]:
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        comp[w] = component_count
+                        if w == v:
+                            break
+                    component_count += 1
+    return np.array(comp, dtype=np.int32), component_count
 
 
 class NHDNetwork:
@@ -54,8 +164,8 @@ class NHDNetwork:
     created from NHDWaterbody feature class
     :ivar dict nhdpid_waterbody: Dictionary with key = Waterbody NHDPlusID, value = Waterbody Permanent_Identifier,
     created from NHDWaterbody feature class
-    :ivar set intermit_flowline_ids: Set of Permanent_Identifiers for NHDFlowlines assigned intermittent FCodes 46003,
-    46007
+    :ivar frozenset intermit_flowline_ids: Set of Permanent_Identifiers for NHDFlowlines assigned intermittent FCodes
+    46003, 46007
     :ivar list inlets: List of Permanent_Identifiers for NHDFlowlines that flow in but have no upstream flowline in this
     gdb
     :ivar list outlets: List of Permanent_Identifiers for NHDFlowlines that flow out but have no downstream flowline in
@@ -92,63 +202,355 @@ class NHDNetwork:
         self.flowline_stop_ids = []
         self.waterbody_stop_ids = []
         self.tenha_waterbody_ids = []
-        self.upstream = defaultdict(list)
-        self.downstream = defaultdict(list)
-        self.nhdpid_flowline = defaultdict(list)
-        self.flowline_waterbody = defaultdict(list)
+        self.nhdpid_flowline = {}
+        self.flowline_waterbody = {}
         self.waterbody_flowline = defaultdict(list)
-        self.waterbody_nhdpid = defaultdict(list)
-        self.nhdpid_waterbody = defaultdict(list)
-        self.intermit_flowline_ids = set()
+        self._wb_id2idx = {}
+        self._wb_indptr = None
+        self._wb_flowline_ids = None
+        self._wb_idx2id = None
+        self._fl2wb = None
+        self.waterbody_nhdpid = {}
+        self.nhdpid_waterbody = {}
+        self.intermit_flowline_ids = frozenset()
         self.inlets = []
         self.outlets = []
         self.outlets_type = None
         self.exclude_intermittent_flow = False
         self.lakes_areas = {}
+        self._lakes_ids_arr = None
+        self._lakes_areas_arr = None
+        self._waterbody_table = None
+        self._lagos_pop_ids = {}
+        # raw flow table edges, read once and re-filtered in memory when the network rules change
+        self._fr_all = None
+        self._to_all = None
+        self._fr_all_idx = None
+        self._to_all_idx = None
+        self._intermit_all = None
+        self._edge_keep = {}
+        # network stored as CSR arrays over a dense integer index of flow table identifiers
+        self._node_ids = None
+        self._idx2id = None
+        self._id2idx = {}
+        self._up_indptr = None
+        self._up_indices = None
+        self._up_keys = None
+        self._dn_indptr = None
+        self._dn_indices = None
+        self._dn_keys = None
+        self._upstream = None
+        self._downstream = None
+        # every flowline with an edge leading into it, per direction, kept until the CSR arrays are rebuilt
+        self._up_targets = None
+        self._dn_targets = None
+        # waterbody trace results, keyed on the barrier configuration in effect when they were traced
+        self._trace_cache = {}
+        self._trace_cache_ids = 0
+        # condensation of the upstream network used by the multi-source trace
+        self._up_condensed = None
+        self._bfs_buffers = None
         # the following should have no effect on other users besides LAGOS use,
         # but will be used to modify .define_lakes so that it includes any permanent_id
         # found in the LAGOS population, regardless of its size or FType in NHDPlus Plus HR
         self.lagos_pop_path = r'F:\Continental_Limnology\Data_Working\LAGOS_US_GIS_Data_v0.9.gdb\Lakes\LAGOS_US_All_Lakes_1ha'
 
     # ---UTILITIES FOR HIGHER METHODS-----------------------------------------------------------------------------------
+    @property
+    def flowline_stop_ids(self):
+        """List of flowline Permanent_Identifiers currently acting as barriers, mirrored in a set for lookups."""
+        return self._flowline_stop_ids
+
+    @flowline_stop_ids.setter
+    def flowline_stop_ids(self, flowline_stop_ids):
+        self._flowline_stop_ids = flowline_stop_ids
+        self._flowline_stop_set = frozenset(flowline_stop_ids)
+        self._stop_mask = None
+
+    @property
+    def waterbody_stop_ids(self):
+        """List of waterbody Permanent_Identifiers currently acting as barriers, mirrored in a set for lookups."""
+        return self._waterbody_stop_ids
+
+    @waterbody_stop_ids.setter
+    def waterbody_stop_ids(self, waterbody_stop_ids):
+        self._waterbody_stop_ids = waterbody_stop_ids
+        self._waterbody_stop_set = frozenset(waterbody_stop_ids)
+
+    @property
+    def upstream(self):
+        """Dictionary with key = to_id, value = list of from_ids, generated from the upstream CSR arrays on first
+        access."""
+        if self._upstream is None:
+            self._upstream = self._csr_to_dict(self._up_indptr, self._up_indices, self._up_keys)
+        return self._upstream
+
+    @property
+    def downstream(self):
+        """Dictionary with key = from_id, value = list of to_ids, generated from the downstream CSR arrays on first
+        access."""
+        if self._downstream is None:
+            self._downstream = self._csr_to_dict(self._dn_indptr, self._dn_indices, self._dn_keys)
+        return self._downstream
+
+    def _csr_to_dict(self, indptr, indices, keys):
+        """Expand CSR adjacency arrays into a dictionary of Permanent_Identifier lists."""
+        flow_dict = defaultdict(list)
+        if indptr is None:
+            return flow_dict
+        for key, start, end in zip(keys.tolist(), indptr[keys].tolist(), indptr[keys + 1].tolist()):
+            flow_dict[self._idx2id[key]] = self._idx2id[indices[start:end]].tolist()
+        return flow_dict
+
+    def _load_flow(self):
+        """
+        Read the flow table edges and build the shared network index, if not already done. Later network rebuilds
+        (e.g. toggling intermittent flow) filter these cached edges instead of re-reading the table.
+        :return: None
+        """
+        if self._fr_all is None:
+            self._fr_all, self._to_all = _read_flow_once(self.flow, self.from_column, self.to_column)
+            self._node_ids = np.unique(np.concatenate([self._fr_all, self._to_all]))
+            # intern the identifiers so every dictionary built by the class shares one hashed object per id
+            self._idx2id = np.array([sys.intern(id) for id in self._node_ids.tolist()], dtype=object)
+            self._id2idx = {id: i for i, id in enumerate(self._idx2id)}
+            self._fr_all_idx = np.searchsorted(self._node_ids, self._fr_all).astype(np.int32)
+            self._to_all_idx = np.searchsorted(self._node_ids, self._to_all).astype(np.int32)
+
+    def _flow_mask(self, direction):
+        """
+        Flag the flow table rows to keep as network edges, judged on the upstream end (direction 'up') or downstream
+        end ('down') of each edge. Rows where that end is '0' or an excluded intermittent flowline are dropped.
+        Masks are computed once per intermittent flow setting and cached.
+        :param str direction: 'up' or 'down'
+        :return: Tuple of boolean arrays (keep, is_zero) with one entry per flow table row
+        """
+        if direction not in self._edge_keep:
+            end_idx = self._fr_all_idx if direction == 'up' else self._to_all_idx
+            dropped = np.zeros(len(self._node_ids), dtype=np.bool_)
+            dropped[self._to_idx(self.intermit_flowline_ids)] = True  # see drop_intermittent_flow
+            is_zero = end_idx == self._id2idx.get('0', -1)
+            self._edge_keep[direction] = (~is_zero & ~dropped[end_idx], is_zero)
+        return self._edge_keep[direction]
+
+    def _to_idx(self, ids):
+        """Convert Permanent_Identifiers to network indices, skipping any not present in the flow table."""
+        return np.fromiter((self._id2idx[id] for id in ids if id in self._id2idx), dtype=np.int32)
+
+    def _flowline_waterbody_index(self):
+        """
+        Dense network index -> waterbody index array (-1 for flowlines outside any waterbody), built on first use.
+        Waterbody indices convert back to Permanent_Identifiers through self._wb_idx2id.
+        :return: int32 array over the network index
+        """
+        if self._fl2wb is None:
+            if self._wb_indptr is None:
+                self._map_flowline_waterbody_both()
+            self._wb_idx2id = np.array(list(self._wb_id2idx.keys()), dtype=object)
+            self._fl2wb = np.full(len(self._node_ids), -1, dtype=np.int32)
+            for flowline_id, waterbody_id in self.flowline_waterbody.items():
+                if flowline_id in self._id2idx:
+                    self._fl2wb[self._id2idx[flowline_id]] = self._wb_id2idx[waterbody_id]
+        return self._fl2wb
+
+    def _trace_waterbodies(self, trace_idx):
+        """
+        Look up the waterbodies of traced flowlines through the dense network index -> waterbody index array.
+        :param numpy.ndarray trace_idx: Network indices of the traced flowlines
+        :return: Set of waterbody Permanent_Identifiers associated with any of the traced flowlines
+        """
+        wb_idx = self._flowline_waterbody_index()[trace_idx]
+        return set(self._wb_idx2id[np.unique(wb_idx[wb_idx >= 0])].tolist())
+
+    def _finish_trace(self, trace_idx, start_ids, waterbody_start_id=None):
+        """
+        Convert a multi-start trace to Permanent_Identifiers and add the traced waterbodies, except any active
+        waterbody stops.
+        :param numpy.ndarray trace_idx: Network indices of the traced flowlines
+        :param list start_ids: Flowline Permanent_Identifiers the trace started from. Any missing from the flow table
+        are still part of their own trace.
+        :param str waterbody_start_id: Optional waterbody the trace started from, which is kept even if it is a stop
+        :return: List of flowline and waterbody Permanent_Identifiers
+        """
+        trace = set(self._idx2id[trace_idx].tolist())
+        wb_permids = self._trace_waterbodies(trace_idx)
+        for id in start_ids:
+            if id not in self._id2idx:
+                trace.add(id)
+                if id in self.flowline_waterbody:
+                    wb_permids.add(self.flowline_waterbody[id])
+        trace.update(wb_permids.difference(self._waterbody_stop_set - {waterbody_start_id}))
+        return list(trace)
+
+    def _trace_cache_key(self, direction, start_id):
+        """Key for the trace cache: the trace request plus the barriers and flow rules now in effect."""
+        return (direction, start_id, self._flowline_stop_set, self._waterbody_stop_set,
+                self.exclude_intermittent_flow)
+
+    def _cache_trace(self, key, trace):
+        """Store a trace result, dropping the oldest entries so the cache holds at most TRACE_CACHE_IDS identifiers in
+        total. Traces too large to fit on their own are not stored."""
+        if len(trace) > TRACE_CACHE_IDS:
+            return
+        if key in self._trace_cache:
+            self._trace_cache_ids -= len(self._trace_cache.pop(key))
+        while self._trace_cache_ids + len(trace) > TRACE_CACHE_IDS:
+            self._trace_cache_ids -= len(self._trace_cache.pop(next(iter(self._trace_cache))))
+        self._trace_cache[key] = trace
+        self._trace_cache_ids += len(trace)
+
+    def _clear_trace_cache(self):
+        """Drop every memoized trace."""
+        self._trace_cache.clear()
+        self._trace_cache_ids = 0
+
+    def _stop_mask_array(self):
+        """uint8 array over the network index flagging the flowline stops now active, rebuilt when the stops change."""
+        if self._stop_mask is None:
+            self._stop_mask = np.zeros(len(self._node_ids), dtype=np.uint8)
+            self._stop_mask[self._to_idx(self._flowline_stop_set)] = 1
+        return self._stop_mask
+
+    def _trace_buffers(self):
+        """
+        Visited and queue buffers for the compiled trace kernels, allocated once per network and handed back clean
+        (visited all False) after every trace.
+        :return: Tuple of (visited_up, visited_dn, queue_up, queue_dn)
+        """
+        if self._bfs_buffers is None:
+            node_count = len(self._node_ids)
+            self._bfs_buffers = (np.zeros(node_count, dtype=np.bool_), np.zeros(node_count, dtype=np.bool_),
+                                 np.empty(node_count, dtype=np.int32), np.empty(node_count, dtype=np.int32))
+        return self._bfs_buffers
+
+    def _trace_csr(self, indptr, indices, sources):
+        """
+        Breadth-first trace over CSR adjacency arrays from one or more start nodes. The start nodes' immediate
+        neighbors are always traced; beyond that, flowline stops currently activated on the network halt the trace.
+        :param numpy.ndarray indptr: CSR row pointer array for the trace direction
+        :param numpy.ndarray indices: CSR neighbor array for the trace direction
+        :param sources: Network index, or array of network indices, of the start flowlines
+        :return: Array of network indices for every node in the trace (including the start nodes)
+        """
+        sources = np.atleast_1d(np.asarray(sources, dtype=np.int32))
+        blocked = self._stop_mask_array()
+
+        # use the compiled kernel when numba is available
+        if _trace_kernels.HAVE_NUMBA:
+            visited, _, queue, _ = self._trace_buffers()
+            count = _trace_kernels.bfs_csr(indptr, indices, sources, blocked, visited, queue)
+            traced = queue[:count].copy()
+            visited[traced] = False
+            return traced
+
+        visited = np.zeros(len(indptr) - 1, dtype=np.bool_)
+        # owner records which position in the candidate list claimed a node, so duplicates drop out in O(k)
+        owner = np.empty(len(visited), dtype=np.int64)
+        visited[sources] = True
+        frontier = _gather_csr(indptr, indices, sources)
+        frontier = frontier[~visited[frontier]]
+        visited[frontier] = True
+        visited_or_blocked = visited | blocked.astype(np.bool_)
+
+        # while there is still network left, expand the whole frontier at once and keep only the new nodes
+        while frontier.size:
+            neighbors = _gather_csr(indptr, indices, frontier)
+            candidates = neighbors[~visited_or_blocked[neighbors]]
+            positions = np.arange(len(candidates))
+            owner[candidates] = positions
+            frontier = candidates[owner[candidates] == positions]
+            visited[frontier] = True
+            visited_or_blocked[frontier] = True
+        return np.flatnonzero(visited)
+
+    def _trace_bidirectional(self, up_sources, dn_sources):
+        """
+        Trace upstream from one set of start nodes and downstream from another in a single call. With numba available
+        both directions run in one fused kernel; otherwise this is two _trace_csr calls.
+        :param numpy.ndarray up_sources: Network indices to start the upstream trace from
+        :param numpy.ndarray dn_sources: Network indices to start the downstream trace from
+        :return: Tuple of (upstream, downstream) arrays of traced network indices
+        """
+        self.prepare_upstream()
+        self.prepare_downstream()
+        up_sources = np.asarray(up_sources, dtype=np.int32)
+        dn_sources = np.asarray(dn_sources, dtype=np.int32)
+        if not _trace_kernels.HAVE_NUMBA:
+            return (self._trace_csr(self._up_indptr, self._up_indices, up_sources),
+                    self._trace_csr(self._dn_indptr, self._dn_indices, dn_sources))
+
+        visited_up, visited_dn, queue_up, queue_dn = self._trace_buffers()
+        count_up, count_dn = _trace_kernels.bfs_bidir_csr(self._up_indptr, self._up_indices,
+                                                          self._dn_indptr, self._dn_indices,
+                                                          up_sources, dn_sources, self._stop_mask_array(),
+                                                          visited_up, visited_dn, queue_up, queue_dn)
+        traced_up = queue_up[:count_up].copy()
+        traced_dn = queue_dn[:count_dn].copy()
+        visited_up[traced_up] = False
+        visited_dn[traced_dn] = False
+        return traced_up, traced_dn
+
+    def _condense_upstream(self):
+        """
+        Condense the upstream network into a DAG of strongly connected components (circular flow collapses into a
+        single component) and group the DAG edges into levels for the multi-source trace. Cached until the upstream
+        arrays are rebuilt.
+        :return: Tuple of (comp, component_count, edge_from, edge_to, level_bounds). Edges within
+        level_bounds[i]:level_bounds[i + 1] only depend on components finished at earlier levels.
+        """
+        if self._up_condensed is None:
+            comp, component_count = _strong_components(self._up_indptr, self._up_indices)
+            rows = np.repeat(np.arange(len(self._node_ids), dtype=np.int32), np.diff(self._up_indptr))
+            edges = np.unique(np.stack([comp[rows], comp[self._up_indices]], axis=1), axis=0)
+            edges = edges[edges[:, 0] != edges[:, 1]]
+            # reverse topological numbering: downstream components have higher numbers, so walk them first
+            edges = edges[np.argsort(-edges[:, 0], kind='stable')]
+            level = [0] * component_count
+            for edge_from, edge_to in edges.tolist():
+                if level[edge_from] + 1 > level[edge_to]:
+                    level[edge_to] = level[edge_from] + 1
+            edge_level = np.array(level, dtype=np.int32)[edges[:, 1]] if len(edges) else np.zeros(0, np.int32)
+            order = np.argsort(edge_level, kind='stable')
+            edges = edges[order]
+            level_bounds = np.searchsorted(edge_level[order], np.arange(edge_level.max() + 2 if len(edges) else 1))
+            self._up_condensed = (comp, component_count, edges[:, 0], edges[:, 1], level_bounds)
+        return self._up_condensed
+
     def prepare_upstream(self, force_refresh=False):
         """
-        Read the geodatabase flow table and collapse into a flow dictionary, if the flow dictionary was not already
-        generated.
-        :param bool force_refresh: Force the function to re-generate the flow dictionary, even if it already exists.
+        Collapse the geodatabase flow table into upstream CSR arrays, if they were not already generated. The table
+        itself is only read once per NHDNetwork.
+        :param bool force_refresh: Force the function to re-generate the flow arrays, even if they already exist.
         :return: self.upstream
         """
-        """Read the geodatabase flow table and collapse into a flow dictionary."""
-        if not self.upstream or force_refresh:
-            self.upstream = defaultdict(list)
-            with arcpy.da.SearchCursor(self.flow, [self.from_column, self.to_column]) as cursor:
-                for row in cursor:
-                    from_id, to_id = row
-                    if from_id == '0': # see drop_intermittent_flow
-                        self.upstream[to_id] = []
-                    elif from_id not in self.intermit_flowline_ids: # see drop_intermittent_flow
-                        self.upstream[to_id].append(from_id)
-                    else:
-                        continue
+        if self._up_indptr is None or force_refresh:
+            self._load_flow()
+            keep, is_zero = self._flow_mask('up')
+            to_idx = self._to_all_idx
+            self._up_indptr, self._up_indices = _build_csr(to_idx[keep], self._fr_all_idx[keep], len(self._node_ids))
+            self._up_keys = np.unique(to_idx[keep | is_zero])
+            self._upstream = None
+            self._up_targets = None
+            self._up_condensed = None
+            self._clear_trace_cache()
         return self.upstream
 
     def prepare_downstream(self, force_refresh=False):
-        """Read the geodatabase flow table and collapse into a flow dictionary.
+        """Collapse the geodatabase flow table into downstream CSR arrays, if they were not already generated. The table
+        itself is only read once per NHDNetwork.
 
-        :param force_refresh: Force the function to re-generate the flow dictionary, even if it already exists.
+        :param force_refresh: Force the function to re-generate the flow arrays, even if they already exist.
         :return: self.downstream
         """
-        if not self.downstream or force_refresh:
-            self.downstream = defaultdict(list)
-            with arcpy.da.SearchCursor(self.flow, [self.from_column, self.to_column]) as cursor:
-                for row in cursor:
-                    from_id, to_id = row
-                    if to_id == '0':
-                        self.downstream[from_id] = []
-                    elif to_id not in self.intermit_flowline_ids: # see drop_intermittent_flow
-                        self.downstream[from_id].append(to_id)
-                    else:
-                        continue
+        if self._dn_indptr is None or force_refresh:
+            self._load_flow()
+            keep, is_zero = self._flow_mask('down')
+            from_idx = self._fr_all_idx
+            self._dn_indptr, self._dn_indices = _build_csr(from_idx[keep], self._to_all_idx[keep], len(self._node_ids))
+            self._dn_keys = np.unique(from_idx[keep | is_zero])
+            self._downstream = None
+            self._dn_targets = None
+            self._clear_trace_cache()
         return self.downstream
 
     def map_nhdpid_to_flowlines(self):
@@ -156,8 +558,9 @@ class NHDNetwork:
         Construct the nhdpid_flowline identifier mapping dictionary.
         :return: self.nhdpid_flowline
         """
-        self.nhdpid_flowline = {r[0]: r[1]
-                                for r in arcpy.da.SearchCursor(self.flowline, ['NHDPlusID', 'Permanent_Identifier'])}
+        flowlines = arcpy.da.TableToNumPyArray(self.flowline, ['NHDPlusID', 'Permanent_Identifier'])
+        permids = [sys.intern(id) for id in flowlines['Permanent_Identifier'].tolist()]
+        self.nhdpid_flowline = dict(zip(flowlines['NHDPlusID'].tolist(), permids))
         return self.nhdpid_flowline
 
     def map_waterbody_to_nhdpids(self):
@@ -165,9 +568,11 @@ class NHDNetwork:
         Construct the waterbody_nhdpid and nhdpid_waterbody identifier mapping dictionaries.
         :return: None
         """
-        self.waterbody_nhdpid = {r[0]: r[1]
-                                 for r in arcpy.da.SearchCursor(self.waterbody, ['Permanent_Identifier', 'NHDPlusID'])}
-        self.nhdpid_waterbody = {v: k for k, v in list(self.waterbody_nhdpid.items())}
+        waterbodies = arcpy.da.TableToNumPyArray(self.waterbody, ['Permanent_Identifier', 'NHDPlusID'])
+        permids = [sys.intern(id) for id in waterbodies['Permanent_Identifier'].tolist()]
+        nhdpids = waterbodies['NHDPlusID'].tolist()
+        self.waterbody_nhdpid = dict(zip(permids, nhdpids))
+        self.nhdpid_waterbody = dict(zip(nhdpids, permids))
 
     def drop_intermittent_flow(self):
         """
@@ -175,15 +580,19 @@ class NHDNetwork:
         between them is not permanent).
         :return: None
         """
-        self.intermit_flowline_ids= {r[0] for r in arcpy.da.SearchCursor(self.flowline,
-                                                        ['Permanent_Identifier', 'FCode']) if
-                                     r[1] in [46003, 46007]}
+        if self._intermit_all is None:
+            flowlines = arcpy.da.TableToNumPyArray(self.flowline, ['Permanent_Identifier', 'FCode'],
+                                                   null_value={'FCode': -1})
+            intermittent = np.isin(flowlines['FCode'], [46003, 46007])
+            self._intermit_all = frozenset(map(sys.intern, flowlines['Permanent_Identifier'][intermittent].tolist()))
+        self.intermit_flowline_ids = self._intermit_all
         self.exclude_intermittent_flow = True
+        self._edge_keep = {}
 
         # refresh the upstream/downstream dictionaries
-        if self.upstream:
+        if self._up_indptr is not None:
             self.prepare_upstream(force_refresh=True)
-        if self.downstream:
+        if self._dn_indptr is not None:
             self.prepare_downstream(force_refresh=True)
 
     def include_intermittent_flow(self):
@@ -193,38 +602,75 @@ class NHDNetwork:
         drop_intermittent_flow was previously called.
         :return: None
         """
-        self.intermit_flowline_ids = set()
+        self.intermit_flowline_ids = frozenset()
         self.exclude_intermittent_flow = False
+        self._edge_keep = {}
 
         # refresh the upstream/downstream dictionaries
-        if self.upstream:
+        if self._up_indptr is not None:
             self.prepare_upstream(force_refresh=True)
-        if self.downstream:
+        if self._dn_indptr is not None:
             self.prepare_downstream(force_refresh=True)
 
     def map_flowlines_to_waterbodies(self):
         """
-        Construct the flowline_waterbody identifier mapping dictionary.
+        Construct the flowline_waterbody identifier mapping dictionary. Shares one NHDFlowline read with
+        map_waterbodies_to_flowlines.
         :return: self.flowline_waterbody
         """
-        self.flowline_waterbody = {r[0]: r[1]
-                                   for r in arcpy.da.SearchCursor(self.flowline,
-                                                                  ['Permanent_Identifier',
-                                                                   'WBArea_Permanent_Identifier'])
-                                   if r[1]}
+        if self._wb_indptr is None:
+            self._map_flowline_waterbody_both()
         return self.flowline_waterbody
 
     def map_waterbodies_to_flowlines(self):
         """
-        Construct the waterbody_flowline identifier mapping dictionary.
+        Construct the waterbody_flowline identifier mapping dictionary, backed by CSR arrays over the waterbodies.
+        Shares one NHDFlowline read with map_flowlines_to_waterbodies.
         :return: self.waterbody_flowline
         """
+        if self._wb_indptr is None:
+            self._map_flowline_waterbody_both()
+        return self.waterbody_flowline
+
+    def _map_flowline_waterbody_both(self):
+        """
+        Read the flowline-waterbody pairs from NHDFlowline once and build both flowline_waterbody and
+        waterbody_flowline (with its CSR arrays) from them.
+        :return: None
+        """
         with arcpy.da.SearchCursor(self.flowline, ['Permanent_Identifier', 'WBArea_Permanent_Identifier']) as cursor:
-            for row in cursor:
-                flowline_id, waterbody_id = row
-                if waterbody_id:
-                    self.waterbody_flowline[waterbody_id].append(flowline_id)
-        self.waterbody_flowline
+            rows = list(cursor)
+        pairs = [(sys.intern(flowline_id), sys.intern(waterbody_id)) for flowline_id, waterbody_id in rows
+                 if waterbody_id]
+        self.flowline_waterbody = dict(pairs)
+        flowline_ids = np.array([p[0] for p in pairs], dtype=object)
+        waterbody_ids = [p[1] for p in pairs]
+
+        # waterbodies are numbered in order of first appearance, flowlines stay in table order within each waterbody
+        self._wb_id2idx = {}
+        for waterbody_id in waterbody_ids:
+            self._wb_id2idx.setdefault(waterbody_id, len(self._wb_id2idx))
+        wb_idx = np.fromiter((self._wb_id2idx[id] for id in waterbody_ids), dtype=np.int32, count=len(waterbody_ids))
+        order = np.argsort(wb_idx, kind='stable')
+        self._wb_flowline_ids = flowline_ids[order]
+        self._wb_indptr = np.zeros(len(self._wb_id2idx) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(wb_idx, minlength=len(self._wb_id2idx)), out=self._wb_indptr[1:])
+
+        self.waterbody_flowline = defaultdict(list)
+        bounds = self._wb_indptr.tolist()
+        for waterbody_id, i in self._wb_id2idx.items():
+            self.waterbody_flowline[waterbody_id] = self._wb_flowline_ids[bounds[i]:bounds[i + 1]].tolist()
+
+    def _waterbody_flowlines(self, waterbody_ids):
+        """
+        Collect the flowlines of many waterbodies at once from the waterbody_flowline CSR arrays.
+        :param list waterbody_ids: Waterbody Permanent_Identifiers
+        :return: List of flowline Permanent_Identifiers for all of the waterbodies
+        """
+        if self._wb_indptr is None:
+            self.map_waterbodies_to_flowlines()
+        idxs = np.fromiter((self._wb_id2idx[id] for id in waterbody_ids if id in self._wb_id2idx), dtype=np.int32)
+        return _gather_csr(self._wb_indptr, self._wb_flowline_ids, idxs).tolist()
 
     def define_lakes(self, strict_minsize=False, force_lagos=False):
         """Define the lakes to be used in NHDNetwork methods by creating an attribute with a dictionary of lakes and
@@ -237,24 +683,48 @@ class NHDNetwork:
         :return self.lakes_areas: A dictionary with lake permids as the keys and the lake area as the values.
         """
         self.lakes_areas = {} # clear prior definition
+        self._lakes_ids_arr = None
         lagos_fcode_list = lagosGIS.LAGOS_FCODE_LIST
         lake_minsize = 0.01 if strict_minsize else 0.009
         if force_lagos:
             if arcpy.Exists(self.lagos_pop_path):
                 arcpy.AddMessage("Defining lakes with force_lagos = True...")
-                force_ids = {r[0] for r in arcpy.da.SearchCursor(self.lagos_pop_path, 'Permanent_Identifier')}
+                if self.lagos_pop_path not in self._lagos_pop_ids:
+                    with arcpy.da.SearchCursor(self.lagos_pop_path, 'Permanent_Identifier') as cursor:
+                        self._lagos_pop_ids[self.lagos_pop_path] = {r[0] for r in list(cursor)}
+                force_ids = self._lagos_pop_ids[self.lagos_pop_path]
             else:
                 arcpy.AddMessage("Parameter to force LAGOS lake population was requested but the LAGOS lake path does not exist.")
                 force_ids = {}
         else:
             force_ids = {}
-        with arcpy.da.SearchCursor(self.waterbody, ['Permanent_Identifier', 'AreaSqKm', 'FCode']) as cursor:
-            for row in cursor:
-                id, area, fcode = row
-                if (area >= lake_minsize and fcode in lagos_fcode_list) or id in force_ids:
-                    self.lakes_areas[id] = area
+        # the waterbody table is read once, later definitions only re-filter it
+        if self._waterbody_table is None:
+            self._waterbody_table = arcpy.da.TableToNumPyArray(self.waterbody,
+                                                               ['Permanent_Identifier', 'AreaSqKm', 'FCode'],
+                                                               null_value={'AreaSqKm': -1, 'FCode': -1})
+        waterbodies = self._waterbody_table
+        ids = waterbodies['Permanent_Identifier']
+        is_lake = (waterbodies['AreaSqKm'] >= lake_minsize) & np.isin(waterbodies['FCode'], lagos_fcode_list)
+        if force_ids:
+            is_lake |= np.isin(ids, list(force_ids))
+        lake_ids = map(sys.intern, ids[is_lake].tolist())
+        self.lakes_areas = dict(zip(lake_ids, waterbodies['AreaSqKm'][is_lake].tolist()))
+        self._lakes_arrays()
         return self.lakes_areas
 
+    def _lakes_arrays(self):
+        """
+        Parallel arrays of the lake ids and areas in self.lakes_areas, for vectorized area thresholds. Rebuilt if
+        lakes_areas no longer matches them.
+        :return: Tuple of (ids, areas) arrays
+        """
+        if self._lakes_ids_arr is None or len(self._lakes_ids_arr) != len(self.lakes_areas):
+            self._lakes_ids_arr = np.array(list(self.lakes_areas.keys()), dtype=object)
+            self._lakes_areas_arr = np.fromiter(self.lakes_areas.values(), dtype=np.float64,
+                                                count=len(self.lakes_areas))
+        return self._lakes_ids_arr, self._lakes_areas_arr
+
     # ---NETWORK SETUP FOR TRACING--------------------------------------------------------------------------------------
     def set_start_ids(self, waterbody_start_ids):
         """
@@ -265,12 +735,8 @@ class NHDNetwork:
         start locations).
         :return self.flowline_start_ids: List of FLOWLINE Permanent_Identifiers from which further tracing will start
         """
-        if not self.waterbody_flowline:
-            self.map_waterbodies_to_flowlines()
         self.waterbody_start_ids = waterbody_start_ids
-        flowline_ids_unflat = [self.waterbody_flowline[lake_id] for lake_id in waterbody_start_ids]
-        # flatten before returning
-        self.flowline_start_ids = [id for id_list in flowline_ids_unflat for id in id_list]
+        self.flowline_start_ids = self._waterbody_flowlines(waterbody_start_ids)
         return self.flowline_start_ids
 
     def set_stop_ids(self, waterbody_stop_ids):
@@ -283,12 +749,8 @@ class NHDNetwork:
         :param list waterbody_stop_ids: List of WATERBODY Permanent_Identifiers to act as barriers.
         :return self.flowline_stop_ids: List of FLOWLINE Permanent_Identifiers used as barriers
         """
-        if not self.waterbody_flowline:
-            self.map_waterbodies_to_flowlines()
         self.waterbody_stop_ids = waterbody_stop_ids
-        flowline_ids_unflat = [self.waterbody_flowline[lake_id] for lake_id in waterbody_stop_ids]
-        # flatten before returning
-        self.flowline_stop_ids = [id for id_list in flowline_ids_unflat for id in id_list]
+        self.flowline_stop_ids = self._waterbody_flowlines(waterbody_stop_ids)
         return self.flowline_stop_ids
 
     def activate_10ha_lake_stops(self):
@@ -299,7 +761,8 @@ class NHDNetwork:
         if not self.lakes_areas:
             self.define_lakes()
 
-        self.waterbody_stop_ids = [id for id, area in list(self.lakes_areas.items()) if area >= 0.1]
+        lake_ids, lake_areas = self._lakes_arrays()
+        self.waterbody_stop_ids = lake_ids[lake_areas >= 0.1].tolist()
         # and set the flowlines too
         self.set_stop_ids(self.waterbody_stop_ids)
         # and save stable for re-use by network class
@@ -327,46 +790,26 @@ class NHDNetwork:
         which includes the input flow destination
 
         """
-        if not self.upstream:
-            self.prepare_upstream()
-        if self.flowline_stop_ids:
-            stop_ids_set = set(self.flowline_stop_ids)
-
-        # get the next IDs up from the start
-        from_ids = self.upstream[flowline_start_id]
-        all_from_ids = from_ids[:]
-        all_from_ids.append(flowline_start_id)  # include start point in trace
-        limit = len(self.upstream)
-
-        # while there is still network left, iteratively trace up and add on
-        while from_ids:
-            next_up = [self.upstream[id] for id in from_ids]
-
-            # flatten results
-            next_up_flat = set([id for id_list in next_up for id in id_list])
-            if self.flowline_stop_ids:
-                next_up_flat = next_up_flat.difference(stop_ids_set)
-
-            # seed the new start point
-            # if the network size exceeds number of network features, it's because of circular flow
-            # de-duplicate trace and make sure from_ids are NEW in that case before proceeding
-            if len(all_from_ids) >= limit:
-                all_from_ids = list(set(all_from_ids))
-                from_ids = next_up_flat.difference(set(all_from_ids))
-            # otherwise the trace just walks upstream and records the results of this iteration
-            else:
-                from_ids = next_up_flat
-            all_from_ids.extend(from_ids)
+        self.prepare_upstream()
+        key = self._trace_cache_key('up_flowline', (flowline_start_id, include_wb_permids))
+        if key in self._trace_cache:
+            return self._trace_cache[key][:]
+        if flowline_start_id in self._id2idx:
+            trace_idx = self._trace_csr(self._up_indptr, self._up_indices, self._id2idx[flowline_start_id])
+            all_from_ids = self._idx2id[trace_idx].tolist()
+        else:
+            trace_idx = np.zeros(0, dtype=np.int64)
+            all_from_ids = [flowline_start_id]
 
-        all_from_ids = list(set(all_from_ids))
         if include_wb_permids:
-            if not self.flowline_waterbody:
-                self.map_flowlines_to_waterbodies()
             # get the waterbody ids for all flowlines in trace (including start) and add to results
-            wb_permids_set = {self.flowline_waterbody[id] for id in all_from_ids if id in self.flowline_waterbody}
-            wb_permids = list(wb_permids_set.difference(set(self.waterbody_stop_ids)))  # if stops present, remove
+            wb_permids_set = self._trace_waterbodies(trace_idx)
+            if flowline_start_id not in self._id2idx and flowline_start_id in self.flowline_waterbody:
+                wb_permids_set.add(self.flowline_waterbody[flowline_start_id])
+            wb_permids = list(wb_permids_set.difference(self._waterbody_stop_set))  # if stops present, remove
             all_from_ids.extend(wb_permids)
-        return list(set(all_from_ids))
+        self._cache_trace(key, all_from_ids[:])
+        return all_from_ids
 
     def trace_down_from_a_flowline(self, flowline_start_id, include_wb_permids=True):
         """
@@ -381,46 +824,26 @@ class NHDNetwork:
         which includes the input flow destination
 
         """
-        if not self.downstream:
-            self.prepare_downstream()
-        if self.flowline_stop_ids:
-            stop_ids_set = set(self.flowline_stop_ids)
-
-        # get the next IDs down from the start
-        to_ids = self.downstream[flowline_start_id]
-        all_to_ids = to_ids[:]
-        all_to_ids.append(flowline_start_id)  # include start point in trace
-        limit = len(self.downstream)
-
-        # while there is still network left, iteratively trace down and add on
-        while to_ids:
-            next_down = [self.downstream[id] for id in to_ids]
-
-            # flatten results
-            next_down_flat = set([id for id_list in next_down for id in id_list])
-            if self.flowline_stop_ids:
-                next_down_flat = next_down_flat.difference(stop_ids_set)
-
-            # seed the new start point
-            # if the network size exceeds number of network features, it's because of circular flow
-            # de-duplicate trace and make sure from_ids are NEW in that case before proceeding
-            if len(all_to_ids) >= limit:
-                all_to_ids = list(set(all_to_ids))
-                to_ids = next_down_flat.difference(set(all_to_ids))
-            # otherwise the trace just walks upstream and records the results of this iteration
-            else:
-                to_ids = next_down_flat
-            all_to_ids.extend(to_ids)
+        self.prepare_downstream()
+        key = self._trace_cache_key('down_flowline', (flowline_start_id, include_wb_permids))
+        if key in self._trace_cache:
+            return self._trace_cache[key][:]
+        if flowline_start_id in self._id2idx:
+            trace_idx = self._trace_csr(self._dn_indptr, self._dn_indices, self._id2idx[flowline_start_id])
+            all_to_ids = self._idx2id[trace_idx].tolist()
+        else:
+            trace_idx = np.zeros(0, dtype=np.int64)
+            all_to_ids = [flowline_start_id]
 
-        all_to_ids = list(set(all_to_ids))
         if include_wb_permids:
-            if not self.flowline_waterbody:
-                self.map_flowlines_to_waterbodies()
             # get the waterbody ids for all flowlines in trace (including start) and add to results
-            wb_permids_set = {self.flowline_waterbody[id] for id in all_to_ids if id in self.flowline_waterbody}
-            wb_permids = list(wb_permids_set.difference(set(self.waterbody_stop_ids)))  # if stops present, remove
+            wb_permids_set = self._trace_waterbodies(trace_idx)
+            if flowline_start_id not in self._id2idx and flowline_start_id in self.flowline_waterbody:
+                wb_permids_set.add(self.flowline_waterbody[flowline_start_id])
+            wb_permids = list(wb_permids_set.difference(self._waterbody_stop_set))  # if stops present, remove
             all_to_ids.extend(wb_permids)
-        return list(set(all_to_ids))
+        self._cache_trace(key, all_to_ids[:])
+        return all_to_ids
 
     def trace_up_from_a_waterbody(self, waterbody_start_id):
         """
@@ -439,9 +862,11 @@ class NHDNetwork:
 
         """
         # set up the network if necessary
-        if not self.upstream:
-            self.prepare_upstream()
-        if not self.waterbody_flowline:
+        self.prepare_upstream()
+        key = self._trace_cache_key('up', waterbody_start_id)
+        if key in self._trace_cache:
+            return self._trace_cache[key][:]
+        if self._wb_indptr is None:
             self.map_waterbodies_to_flowlines()
         flowline_start_ids = set(self.waterbody_flowline[waterbody_start_id])  # one or more
 
@@ -449,23 +874,24 @@ class NHDNetwork:
         if self.flowline_stop_ids:
             flowline_stop_ids_restore = self.flowline_stop_ids[:]
             waterbody_stop_ids_restore = self.waterbody_stop_ids[:]
-            self.flowline_stop_ids = [id for id in self.flowline_stop_ids if id not in flowline_start_ids]
-            self.waterbody_stop_ids = [id for id in self.waterbody_stop_ids if id not in waterbody_start_id]
+            self.flowline_stop_ids = list(self._flowline_stop_set - flowline_start_ids)
+            self.waterbody_stop_ids = list(self._waterbody_stop_set - {waterbody_start_id})
             reset_stops = True
         else:
             reset_stops = False  # use in case all stop ids are erased
 
-        lowest_flowline_start_ids = set(self.identify_lake_outlets(waterbody_start_id))
+        lowest_flowline_start_ids = self.identify_lake_outlets(waterbody_start_id)
 
-        # then trace up for all and flatten result
-        unflat_trace_all = [self.trace_up_from_a_flowline(id, True) for id in lowest_flowline_start_ids]
-        all_from_ids = list({id for id_list in unflat_trace_all for id in id_list})
+        # then trace up from all outlets at once, so the result accumulates without flattening per-outlet lists
+        traced = self._trace_csr(self._up_indptr, self._up_indices, self._to_idx(lowest_flowline_start_ids))
+        all_from_ids = self._finish_trace(traced, lowest_flowline_start_ids)
 
         # reset flowline_stop_ids
         if reset_stops:
             self.flowline_stop_ids = flowline_stop_ids_restore[:]
             self.waterbody_stop_ids = waterbody_stop_ids_restore[:]
 
+        self._cache_trace(key, all_from_ids[:])
         return all_from_ids
 
     def trace_down_from_a_waterbody(self, waterbody_start_id):
@@ -485,9 +911,11 @@ class NHDNetwork:
 
         """
         # set up the network if necessary
-        if not self.downstream:
-            self.prepare_downstream()
-        if not self.waterbody_flowline:
+        self.prepare_downstream()
+        key = self._trace_cache_key('down', waterbody_start_id)
+        if key in self._trace_cache:
+            return self._trace_cache[key][:]
+        if self._wb_indptr is None:
             self.map_waterbodies_to_flowlines()
         flowline_start_ids = set(self.waterbody_flowline[waterbody_start_id])  # one or more
 
@@ -495,25 +923,72 @@ class NHDNetwork:
         if self.flowline_stop_ids:
             flowline_stop_ids_restore = self.flowline_stop_ids[:]
             waterbody_stop_ids_restore = self.waterbody_stop_ids[:]
-            self.flowline_stop_ids = [id for id in self.flowline_stop_ids if id not in flowline_start_ids]
-            self.waterbody_stop_ids = [id for id in self.waterbody_stop_ids if id not in waterbody_start_id]
+            self.flowline_stop_ids = list(self._flowline_stop_set - flowline_start_ids)
+            self.waterbody_stop_ids = list(self._waterbody_stop_set - {waterbody_start_id})
             reset_stops = True
         else:
             reset_stops = False  # use in case all stop ids are erased
 
-        highest_flowline_start_ids = set(self.identify_lake_inlets(waterbody_start_id))
+        highest_flowline_start_ids = self.identify_lake_inlets(waterbody_start_id)
 
-        # then trace down for all and flatten result
-        unflat_trace_all = [self.trace_down_from_a_flowline(id, True) for id in highest_flowline_start_ids]
-        all_to_ids = list({id for id_list in unflat_trace_all for id in id_list})
+        # then trace down from all inlets at once, so the result accumulates without flattening per-inlet lists
+        traced = self._trace_csr(self._dn_indptr, self._dn_indices, self._to_idx(highest_flowline_start_ids))
+        all_to_ids = self._finish_trace(traced, highest_flowline_start_ids)
 
         # reset flowline_stop_ids
         if reset_stops:
             self.flowline_stop_ids = flowline_stop_ids_restore[:]
             self.waterbody_stop_ids = waterbody_stop_ids_restore[:]
 
+        self._cache_trace(key, all_to_ids[:])
         return all_to_ids
 
+    def trace_bidirectional_from_a_waterbody(self, waterbody_start_id):
+        """
+        Trace the network both upstream and downstream of the input waterbody in one pass. The results are the same as
+        calling trace_up_from_a_waterbody and trace_down_from_a_waterbody, but both directions share one fused trace
+        (when numba is available) and one round of stop-id setup.
+
+        :param waterbody_start_id: Waterbody Permanent_Identifier to trace from.
+        :return: Tuple of (upstream trace, downstream trace), each a list of Permanent_Identifier values for flowlines
+        and waterbodies. Both are empty lists if the waterbody is isolated.
+        """
+        self.prepare_upstream()
+        self.prepare_downstream()
+        up_key = self._trace_cache_key('up', waterbody_start_id)
+        down_key = self._trace_cache_key('down', waterbody_start_id)
+        if up_key in self._trace_cache and down_key in self._trace_cache:
+            return self._trace_cache[up_key][:], self._trace_cache[down_key][:]
+        if self._wb_indptr is None:
+            self.map_waterbodies_to_flowlines()
+        flowline_start_ids = set(self.waterbody_flowline[waterbody_start_id])  # one or more
+
+        # remove waterbody's own flowlines from stop ids--don't want them to stop themselves
+        if self.flowline_stop_ids:
+            flowline_stop_ids_restore = self.flowline_stop_ids[:]
+            waterbody_stop_ids_restore = self.waterbody_stop_ids[:]
+            self.flowline_stop_ids = list(self._flowline_stop_set - flowline_start_ids)
+            self.waterbody_stop_ids = list(self._waterbody_stop_set - {waterbody_start_id})
+            reset_stops = True
+        else:
+            reset_stops = False  # use in case all stop ids are erased
+
+        lowest_flowline_start_ids = self.identify_lake_outlets(waterbody_start_id)
+        highest_flowline_start_ids = self.identify_lake_inlets(waterbody_start_id)
+        traced_up, traced_down = self._trace_bidirectional(self._to_idx(lowest_flowline_start_ids),
+                                                           self._to_idx(highest_flowline_start_ids))
+        all_from_ids = self._finish_trace(traced_up, lowest_flowline_start_ids)
+        all_to_ids = self._finish_trace(traced_down, highest_flowline_start_ids)
+
+        # reset flowline_stop_ids
+        if reset_stops:
+            self.flowline_stop_ids = flowline_stop_ids_restore[:]
+            self.waterbody_stop_ids = waterbody_stop_ids_restore[:]
+
+        self._cache_trace(up_key, all_from_ids[:])
+        self._cache_trace(down_key, all_to_ids[:])
+        return all_from_ids, all_to_ids
+
     def trace_up_from_waterbody_starts(self):
         """
         Batch trace up from all waterbody start locations currently set on the NHDNetwork instance.
@@ -526,11 +1001,161 @@ class NHDNetwork:
         :rtype dict
         """
         if self.waterbody_start_ids:
-            results = {id: self.trace_up_from_a_waterbody(id) for id in self.waterbody_start_ids}
-            return results
+            return self.trace_up_from_waterbody_starts_labeled()
         else:
             raise Exception("Populate start IDs with set_start_ids before calling trace_up_from_starts().")
 
+    def trace_down_from_waterbody_starts(self):
+        """
+        Batch trace down from all waterbody start locations currently set on the NHDNetwork instance, with a
+        multi-source labeled pass over the network instead of one trace per waterbody.
+
+        Barriers currently activated on the network will be respected by the trace. The input waterbodies will not
+        act as a barrier for their own traced networks, but will act as barriers for other traces.
+
+        :return Dictionary of traces with key = waterbody Permanent_Identifier, value = list of waterbody and flowline
+        Permanent_Identifiers in the traced network.
+        :rtype dict
+        """
+        if not self.waterbody_start_ids:
+            raise Exception("Populate start IDs with set_start_ids before calling trace_down_from_starts().")
+        self.prepare_downstream()
+        if self._wb_indptr is None:
+            self.map_waterbodies_to_flowlines()
+        start_ids = list(dict.fromkeys(self.waterbody_start_ids))
+        inlets = [self.identify_lake_inlets(id) for id in start_ids]
+
+        results = {}
+        for chunk_start in range(0, len(start_ids), LABEL_CHUNK_SIZE):
+            chunk_ids = start_ids[chunk_start:chunk_start + LABEL_CHUNK_SIZE]
+            chunk_inlets = inlets[chunk_start:chunk_start + LABEL_CHUNK_SIZE]
+            source_nodes = self._label_frontier(self._dn_indptr, self._dn_indices, chunk_ids, chunk_inlets)
+            for source, inlet_ids in enumerate(chunk_inlets):
+                results[chunk_ids[source]] = self._finish_trace(source_nodes[source], inlet_ids, chunk_ids[source])
+        return results
+
+    def trace_up_from_waterbody_starts_labeled(self):
+        """
+        Batch trace up from all waterbody start locations with a single multi-source pass over the network, instead of
+        one trace per waterbody. Each network node is labeled with a bitset of the start waterbodies whose outlets it
+        flows to.
+
+        When no barriers are active, labels are pushed upstream through the strongly connected component DAG one level
+        at a time. When barriers are active, labels spread from node to node instead, so that each waterbody's own
+        flowlines can be exempted from the barriers for its trace alone.
+
+        :return Dictionary of traces with key = waterbody Permanent_Identifier, value = list of waterbody and flowline
+        Permanent_Identifiers in the traced network.
+        :rtype dict
+        """
+        if not self.waterbody_start_ids:
+            raise Exception("Populate start IDs with set_start_ids before calling trace_up_from_starts().")
+
+        self.prepare_upstream()
+        if self._wb_indptr is None:
+            self.map_waterbodies_to_flowlines()
+        start_ids = list(dict.fromkeys(self.waterbody_start_ids))
+        outlets = [self.identify_lake_outlets(id) for id in start_ids]
+
+        results = {}
+        for chunk_start in range(0, len(start_ids), LABEL_CHUNK_SIZE):
+            chunk_ids = start_ids[chunk_start:chunk_start + LABEL_CHUNK_SIZE]
+            chunk_outlets = outlets[chunk_start:chunk_start + LABEL_CHUNK_SIZE]
+            if self.flowline_stop_ids:
+                source_nodes = self._label_frontier(self._up_indptr, self._up_indices, chunk_ids, chunk_outlets)
+            else:
+                source_nodes = self._label_condensed(chunk_outlets)
+            for source, outlet_ids in enumerate(chunk_outlets):
+                results[chunk_ids[source]] = self._finish_trace(source_nodes[source], outlet_ids, chunk_ids[source])
+        return results
+
+    def _label_condensed(self, start_flowline_ids):
+        """
+        Label the upstream network for up to LABEL_CHUNK_SIZE sources by pushing bitsets through the condensed
+        (strongly connected component) DAG. Barriers are not respected.
+        :param list start_flowline_ids: List of start flowline Permanent_Identifiers for each source
+        :return: List of network index arrays, one per source
+        """
+        comp, component_count, edge_from, edge_to, level_bounds = self._condense_upstream()
+        word_count = (len(start_flowline_ids) + 63) // 64
+
+        # seed one bit per source at the components holding its outlets
+        labels = np.zeros((component_count, word_count), dtype=np.uint64)
+        for source, flowline_ids in enumerate(start_flowline_ids):
+            start_comps = comp[self._to_idx(flowline_ids)]
+            labels[start_comps, source // 64] |= np.uint64(1 << (source % 64))
+
+        # push labels upstream, level by level through the DAG
+        for i in range(len(level_bounds) - 1):
+            lo, hi = level_bounds[i], level_bounds[i + 1]
+            if lo < hi:
+                np.bitwise_or.at(labels, edge_to[lo:hi], labels[edge_from[lo:hi]])
+        return self._unpack_labels(labels[comp], len(start_flowline_ids))
+
+    def _label_frontier(self, indptr, indices, waterbody_ids, start_flowline_ids):
+        """
+        Label the network for up to LABEL_CHUNK_SIZE sources by spreading bitsets from newly labeled nodes to their
+        neighbors until no label changes. Barriers are respected with the same rules as one _trace_csr call per
+        source: the start flowlines' immediate neighbors are always traced, and a source's own waterbody flowlines are
+        never barriers for that source.
+        :param numpy.ndarray indptr: CSR row pointer array for the trace direction
+        :param numpy.ndarray indices: CSR neighbor array for the trace direction
+        :param list waterbody_ids: Waterbody Permanent_Identifier of each source
+        :param list start_flowline_ids: List of start flowline Permanent_Identifiers for each source
+        :return: List of network index arrays, one per source
+        """
+        node_count = len(indptr) - 1
+        word_count = (len(waterbody_ids) + 63) // 64
+        blocked = self._stop_mask_array().astype(np.bool_)
+        fl2wb = self._flowline_waterbody_index()
+
+        # labels may enter any node that isn't a stop, but a stop only admits the source whose waterbody holds it
+        allow = np.zeros((node_count, word_count), dtype=np.uint64)
+        allow[~blocked] = np.iinfo(np.uint64).max
+        wb_source = np.full(len(self._wb_idx2id), -1, dtype=np.int64)
+        for source, id in enumerate(waterbody_ids):
+            if id in self._wb_id2idx:
+                wb_source[self._wb_id2idx[id]] = source
+        stop_nodes = np.flatnonzero(blocked & (fl2wb >= 0))
+        stop_sources = wb_source[fl2wb[stop_nodes]]
+        stop_nodes, stop_sources = stop_nodes[stop_sources >= 0], stop_sources[stop_sources >= 0]
+        allow[stop_nodes, stop_sources // 64] = np.left_shift(np.uint64(1), (stop_sources % 64).astype(np.uint64))
+
+        # seed one bit per source at its start flowlines and their immediate neighbors
+        labels = np.zeros((node_count, word_count), dtype=np.uint64)
+        for source, flowline_ids in enumerate(start_flowline_ids):
+            start_idx = self._to_idx(flowline_ids)
+            seeded = np.concatenate([start_idx, _gather_csr(indptr, indices, start_idx)])
+            labels[seeded, source // 64] |= np.uint64(1 << (source % 64))
+
+        # push labels from the nodes that changed to their neighbors, keeping only the bits each neighbor admits
+        frontier = np.flatnonzero(labels.any(axis=1))
+        while frontier.size:
+            targets = _gather_csr(indptr, indices, frontier)
+            origins = np.repeat(frontier, indptr[frontier + 1] - indptr[frontier])
+            touched = np.unique(targets)
+            before = labels[touched]
+            np.bitwise_or.at(labels, targets, labels[origins] & allow[targets])
+            frontier = touched[(labels[touched] != before).any(axis=1)]
+        return self._unpack_labels(labels, len(waterbody_ids))
+
+    def _unpack_labels(self, node_labels, source_count):
+        """
+        Unpack per-node label bitsets into the network indices labeled for each source.
+        :param numpy.ndarray node_labels: uint64 array of shape (network size, words); bit i is set for source i
+        :param int source_count: Number of sources in the labels
+        :return: List of network index arrays, one per source
+        """
+        source_nodes = [np.zeros(0, dtype=np.int64) for _ in range(source_count)]
+        for word in range(node_labels.shape[1]):
+            labeled_nodes = np.flatnonzero(node_labels[:, word])
+            bits = np.unpackbits(node_labels[labeled_nodes, word].astype('<u8').view(np.uint8).reshape(-1, 8),
+                                 axis=1, bitorder='little')
+            bit_sources, positions = np.nonzero(bits.T)
+            bounds = np.searchsorted(bit_sources, np.arange(65))
+            for bit in range(min(64, source_count - 64 * word)):
+                source_nodes[64 * word + bit] = labeled_nodes[positions[bounds[bit]:bounds[bit + 1]]]
+        return source_nodes
 
     def define_interlake_erasable(self):
         """
@@ -593,66 +1218,90 @@ class NHDNetwork:
 
         # traces for each lake in results as sets
         print(("Tracing networks for {} focal lakes...".format(len(focal_lakes))))
+        self.activate_10ha_lake_stops()
+        tenha_ids = frozenset(self.tenha_waterbody_ids)
         self.deactivate_stops()
-        lake_upstream_traces = {k:set(v) for k, v in list(self.trace_up_from_waterbody_starts().items())}
-        lake_downstream_traces = {k:set(self.trace_down_from_a_waterbody(k)) for k in focal_lakes}
+        # the full networks are only needed for their size and the 10ha+ lakes they reach, so keep just those rather
+        # than holding every focal lake's full traces for the whole method. Each trace includes the focal lake itself,
+        # which counts toward the size and keeps its own network out of the eligible and erasable sets below.
+        lake_upstream_sizes = {}
+        lake_upstream_tenha = {}
+        for k, v in self.trace_up_from_waterbody_starts().items():
+            trace = frozenset(v)
+            lake_upstream_sizes[k] = len(trace)
+            lake_upstream_tenha[k] = tenha_ids.intersection(trace)
+        lake_downstream_tenha = {k:tenha_ids.intersection(v)
+                                 for k, v in self.trace_down_from_waterbody_starts().items()}
         self.activate_10ha_lake_stops()
-        lake_interlake_traces = {k:set(v) for k, v in list(self.trace_up_from_waterbody_starts().items())}
+        lake_interlake_traces = {k:frozenset(v) for k, v in self.trace_up_from_waterbody_starts().items()}
         self.deactivate_stops()
 
-        # get conn class for tenha lakes
-        print("Classifying 10ha+ lake connectivity...")
-        tenha_conn = {id:self.classify_waterbody_connectivity(id) for id in self.tenha_waterbody_ids}
-
         # get networks for tenha lakes as sets, both NHDFlowline and NHDWaterbody ids will be included
         self.set_start_ids(self.tenha_waterbody_ids)
-        tenha_nets_full = {k:set(v) for k, v in list(self.trace_up_from_waterbody_starts().items())}
+        tenha_traces_up = self.trace_up_from_waterbody_starts()
+        tenha_nets_full = {k:set(v) for k, v in tenha_traces_up.items()}
+
+        # get conn class for tenha lakes, re-using their upstream traces so only the downstream ones are new
+        print("Classifying 10ha+ lake connectivity...")
+        tenha_traces_down = self.trace_down_from_waterbody_starts()
+        tenha_conn = {k:self._classify_traces(k, v, tenha_traces_down[k]) for k, v in tenha_traces_up.items()}
+        del tenha_traces_down
 
-        tenha_isolated = {k:v for k, v in list(tenha_nets_full.items()) if tenha_conn[k] == 'Isolated'}
-        tenha_terminal_entire = {k:v for k, v in list(tenha_nets_full.items()) if tenha_conn[k] in ('Terminal', 'TerminalLk')}
+        tenha_isolated = {k:v for k, v in tenha_nets_full.items() if tenha_conn[k] == 'Isolated'}
+        tenha_terminal_entire = {k:v for k, v in tenha_nets_full.items() if tenha_conn[k] in ('Terminal', 'TerminalLk')}
         # only portions of terminal networks that are off the main network will be erasable
         on_network = set(self.trace_up_from_hu4_outlets())
-        tenha_terminal = {k:v.difference(on_network) for k, v in list(tenha_terminal_entire.items())}
-        tenha_drainage = {k:v for k, v in list(tenha_nets_full.items())
+        tenha_terminal = {k:v.difference(on_network) for k, v in tenha_terminal_entire.items()}
+        tenha_drainage = {k:v for k, v in tenha_nets_full.items()
                           if tenha_conn[k] in ('Headwater', 'Drainage', 'DrainageLk')}
 
         # all lakes will get isolated added. Use keys because traces are emtpy for Isolated
-        isolated_erasable_segments = set(tenha_isolated.keys())
+        isolated_erasable_segments = frozenset(tenha_isolated.keys())
+
+        # pack the 10ha+ networks into one CSR over a dense index of their members, so that each lake's erasable
+        # region is a single gather and mask test rather than set math against every network
+        tenha_nets = list(tenha_terminal.items()) + list(tenha_drainage.items())
+        member_ids = np.array(sorted(set(chain.from_iterable(v for k, v in tenha_nets))), dtype=object)
+        member_idx = {id:i for i, id in enumerate(member_ids.tolist())}
+        net_indptr = np.zeros(len(tenha_nets) + 1, dtype=np.int32)
+        np.cumsum([len(v) for k, v in tenha_nets], out=net_indptr[1:])
+        net_members = np.fromiter(chain.from_iterable((member_idx[id] for id in v) for k, v in tenha_nets),
+                                  dtype=np.int32, count=net_indptr[-1])
+        terminal_rows = {k:i for i, (k, v) in enumerate(tenha_nets[:len(tenha_terminal)])}
+        drainage_rows = {k:i + len(tenha_terminal) for i, (k, v) in enumerate(tenha_nets[len(tenha_terminal):])}
+        lake_interlake_idx = {k:np.fromiter((member_idx[id] for id in v if id in member_idx), dtype=np.int32)
+                              for k, v in lake_interlake_traces.items()}
+        del lake_interlake_traces
+        interlake_mask = np.zeros(len(member_ids), dtype=np.bool_)
 
         print("Defining erasable regions for each lake...")
         self.deactivate_stops() # get full networks at start of loop
         for lake_id in focal_lakes:
-            # get the focal lake's networks and drop the lake itself so it doesn't test true for being in its own trace
-            focal_downstream = lake_downstream_traces[lake_id].difference(lake_id)
-            focal_upstream = lake_upstream_traces[lake_id].difference(lake_id)
-            focal_interlake = lake_interlake_traces[lake_id].difference(lake_id)
+            focal_downstream_tenha = lake_downstream_tenha[lake_id]
+            focal_upstream_tenha = lake_upstream_tenha[lake_id]
+            focal_interlake_idx = lake_interlake_idx[lake_id]
 
             # NO MORE TRACING TOOLS FROM THIS POINT, JUST SET MATH
             # nothing ever needs erasing if the focal lake is itself Isolated or Headwater, give empty result
-            if len(focal_upstream) < 2:
+            if lake_upstream_sizes[lake_id] < 2:
                 erasable = set()
 
             else:
-                # get qualifying terminal lakes, those not downstream of focal lake
-                terminal_tenha_eligible= {k:v for k, v in list(tenha_terminal.items()) if k not in focal_downstream}
-                # get qualifying drainage lakes, those with outlet of network is upstream of focal_lake
-                tenha_drainage_eligible = {k:v for k, v in list(tenha_drainage.items()) if k in focal_upstream}
-
-                # now that we screened for eligibility, merge dicts and treat the same in the upcoming tests
-                other_tenha_eligible = terminal_tenha_eligible
-                other_tenha_eligible.update(tenha_drainage_eligible)
-
-                # test for complete or partial erasure per D and E in docstring
-                full_erasable = {k:v for k, v in list(other_tenha_eligible.items()) if v.isdisjoint(focal_interlake)}
-                partial_erasable = {k:v.difference(focal_interlake)
-                                    for k, v in list(other_tenha_eligible.items()) if v.intersection(focal_interlake)}
-
-                # convert to flat sets
-                full_erasable_segments = set([id for trace in list(full_erasable.values()) for id in trace])
-                partial_erasable_segments = set([id for trace in list(partial_erasable.values()) for id in trace])
+                # qualifying terminal lakes are those not downstream of focal lake, qualifying drainage lakes are those
+                # with the outlet of the network upstream of focal_lake
+                eligible_rows = [i for k, i in terminal_rows.items() if k not in focal_downstream_tenha]
+                eligible_rows.extend(drainage_rows[k] for k in focal_upstream_tenha if k in drainage_rows)
+
+                # the part of each eligible network outside the focal interlake watershed is erasable: the whole
+                # network when they are disjoint (D in docstring), otherwise the partial network (E in docstring)
+                interlake_mask[focal_interlake_idx] = True
+                members = _gather_csr(net_indptr, net_members, np.array(eligible_rows, dtype=np.int32))
+                erasable_idx = np.unique(members[~interlake_mask[members]])
+                interlake_mask[focal_interlake_idx] = False
 
                 # merge with isolated 10ha+ lakes (all included) to make final result
-                erasable = isolated_erasable_segments.union(full_erasable_segments).union(partial_erasable_segments)
+                erasable = set(isolated_erasable_segments)
+                erasable.update(member_ids[erasable_idx].tolist())
 
             erasable_dict[lake_id] = erasable
 
@@ -667,9 +1316,22 @@ class NHDNetwork:
         :return: Path to the output feature class
         """
         """"""
-        query = 'Permanent_Identifier IN ({})'.format(','.join(['\'{}\''.format(id)
-                                                                for id in trace]))
-        output_fc = arcpy.Select_analysis(self.flowline, output_fc, query)
+        # match ids against a set while copying rows, instead of sending a trace-sized IN clause to the geodatabase
+        trace_ids = set(trace)
+        # copy into memory with the full NHDFlowline schema, then let CopyFeatures resolve output_fc (a bare name in
+        # the current workspace, or a shapefile with shortened field names)
+        trace_fc = DM.CreateFeatureclass('memory', 'trace_flowlines', 'POLYLINE', self.flowline, 'SAME_AS_TEMPLATE',
+                                         'SAME_AS_TEMPLATE', self.flowline)
+        fields = [f.name for f in arcpy.ListFields(self.flowline) if f.editable and f.type != 'Geometry']
+        fields.append('SHAPE@')
+        id_index = fields.index('Permanent_Identifier')
+        with arcpy.da.SearchCursor(self.flowline, fields) as flowline_cursor:
+            with arcpy.da.InsertCursor(trace_fc, fields) as output_cursor:
+                for row in flowline_cursor:
+                    if row[id_index] in trace_ids:
+                        output_cursor.insertRow(row)
+        output_fc = DM.CopyFeatures(trace_fc, output_fc)
+        DM.Delete(trace_fc)
         return output_fc
 
     # ---INLET/OUTLET METHODS-------------------------------------------------------------------------------------------
@@ -681,11 +1343,16 @@ class NHDNetwork:
         """
         if not self.outlets:
             self.identify_subregion_outlets()
-        results_unflat = [self.trace_up_from_a_flowline(id) for id in self.outlets]
-        # convert list of trace-lists to one big list with unique elements
-        results = [id for trace_list in results_unflat for id in trace_list]
-        results_waterbodies = [self.flowline_waterbody[flowid]
-                               for flowid in results if flowid in self.flowline_waterbody]
+        # one multi-start trace covers every outlet network, rather than one trace per outlet
+        trace_idx = self._trace_csr(self._up_indptr, self._up_indices, self._to_idx(self.outlets))
+        results = self._idx2id[trace_idx].tolist()
+        # outlets missing from the flow table are their own trace; dedupe them once before the waterbody lookup
+        untraced_outlets = set(self.outlets).difference(self._id2idx)
+        results.extend(untraced_outlets)
+        # waterbodies of ALL traced flowlines are on the network, including any activated as stops
+        results_waterbodies = self._trace_waterbodies(trace_idx)
+        results_waterbodies.update(self.flowline_waterbody[id]
+                                   for id in untraced_outlets & self.flowline_waterbody.keys())
         results.extend(results_waterbodies)
         return results
 
@@ -693,14 +1360,15 @@ class NHDNetwork:
         """Identify SUBREGION inlets: flowlines that flow in but have no upstream flowline in this gdb.
         :return self.inlets: A list of flowline Permanent_Identifiers for all of the inlets.
         """
-        if not self.downstream:
-            self.prepare_downstream()
-
-        from_ids = set(self.downstream.keys()).difference({'0'})
-        to_all = {f for to_list in list(self.downstream.values()) for f in to_list}
-        upstream_outlets = list(set(from_ids).difference(set(to_all)))
-        inlets_unflat = [v for k, v in list(self.downstream.items()) if k in upstream_outlets]
-        inlets = [i for i_list in inlets_unflat for i in i_list]
+        self.prepare_downstream()
+
+        from_ids = self.downstream.keys() - {'0'}
+        if self._dn_targets is None:
+            self._dn_targets = frozenset(self._idx2id[np.unique(self._dn_indices)].tolist())
+        to_all = self._dn_targets
+        upstream_outlets = from_ids.difference(to_all)
+        inlets_unflat = (self.downstream[k] for k in upstream_outlets)
+        inlets = list(chain.from_iterable(inlets_unflat))
         self.inlets = inlets
         return self.inlets
 
@@ -710,25 +1378,26 @@ class NHDNetwork:
         will be returned.
         :return self.outlets: A list of flowline Permanent_Identifiers for all of the outlets.
         """
-        if not self.upstream:
-            self.prepare_upstream()
+        self.prepare_upstream()
 
         # exclude ToPermanentIdentifier= 0 for first try, is used for flowlines that are network ends.
         # It is also used for flowlines ending in ocean, check for another type of outlet FIRST.
 
-        to_ids = set(self.upstream.keys()).difference({'0'})
-        from_all = {f for from_list in list(self.upstream.values()) for f in from_list}
-        downstream_inlets = list(set(to_ids).difference(set(from_all)))
+        to_ids = self.upstream.keys() - {'0'}
+        if self._up_targets is None:
+            self._up_targets = frozenset(self._idx2id[np.unique(self._up_indices)].tolist())
+        from_all = self._up_targets
+        downstream_inlets = to_ids.difference(from_all)
         # downstream_inlets are lowest flow entity, but typically the NHD includes the
         # inlet for the next subregion down in the table or '0' for the ocean, so outlets_unflat checks for the
         # flow entity(ies) just above the lowest
-        outlets_unflat = [v for k, v in list(self.upstream.items()) if k in downstream_inlets]
-        outlets = [o for o_list in outlets_unflat for o in o_list]
+        outlets_unflat = (self.upstream[k] for k in downstream_inlets)
+        outlets = list(chain.from_iterable(outlets_unflat))
 
         # check that main outlet actually covers > 50% of network, otherwise try secondary
         # outlet determination. Example subregions this affects: 0302, 0303, 0305.
-        outlet_network_lists = [self.trace_up_from_a_flowline(o) for o in outlets]
-        outlet_network = {id for id_list in outlet_network_lists for id in id_list}
+        outlet_network_lists = (self.trace_up_from_a_flowline(o) for o in outlets)
+        outlet_network = set(chain.from_iterable(outlet_network_lists))
         network_fraction = float(len(outlet_network))/len(from_all)
 
         # for subregions with frontal or closed drainage, take the largest network's outlet
@@ -736,21 +1405,19 @@ class NHDNetwork:
         # or in other words, the largest sink possible by my design is 1/2 the hu4 size (by stream segment count)
         if not outlets or network_fraction < .5:
             print("Secondary outlet determination being used due to frontal or closed drainage for the subregion.")
-            to_ids = set(self.upstream.keys()) # allow ocean(0) this time
-            next_up = [self.upstream[id] for id in to_ids]
-            next_up_flat = {id for id_list in next_up for id in id_list}
-            lowest_to_ids = list(to_ids.difference(next_up_flat))
+            # allow ocean(0) this time; every id flowing into any to_id is already collected in from_all
+            lowest_to_ids = list(self.upstream.keys() - from_all)
 
             # if lowest_to_ids is only '0' or only '0' aside from outlets identified previously
             # then at least partial frontal drainage
-            if lowest_to_ids == ['0'] or set(lowest_to_ids).difference(set(downstream_inlets)) == {'0'}:
+            if lowest_to_ids == ['0'] or set(lowest_to_ids).difference(downstream_inlets) == {'0'}:
                 lowest_to_ids.extend(self.upstream['0'])
                 lowest_to_ids.remove('0')
             # otherwise, the subregion has multiple non-ocean outlets, choose some to be "main"
             else:
                 distinct_net_sizes = {id: len(self.trace_up_from_a_flowline(id)) for id in lowest_to_ids}
                 max_net_size = max(distinct_net_sizes.values())
-                outlets = [id for id, n in list(distinct_net_sizes.items()) if n >= .5 * max_net_size]
+                outlets = [id for id, n in distinct_net_sizes.items() if n >= .5 * max_net_size]
                 self.outlets_type = "secondary"
         else:
             self.outlets_type = "primary"
@@ -765,15 +1432,14 @@ class NHDNetwork:
         :return: A list of the flowline Permanent_Identifiers that are associated with the lake outlets
         """
         # set up the network if necessary
-        if not self.upstream:
-            self.prepare_upstream()
-        if not self.waterbody_flowline:
+        self.prepare_upstream()
+        if self._wb_indptr is None:
             self.map_waterbodies_to_flowlines()
         flowline_start_ids = set(self.waterbody_flowline[waterbody_start_id])  # one or more
 
         # identify the lowest start ids
-        next_up = [self.upstream[id] for id in flowline_start_ids]
-        next_up_flat = {id for id_list in next_up for id in id_list}
+        next_up = _gather_csr(self._up_indptr, self._up_indices, self._to_idx(flowline_start_ids))
+        next_up_flat = set(self._idx2id[next_up].tolist())
         lowest_flowline_start_ids = flowline_start_ids.difference(next_up_flat)  # lakes may have multiple outlets
         return list(lowest_flowline_start_ids)
 
@@ -785,15 +1451,14 @@ class NHDNetwork:
         :return: A list of the flowline Permanent_Identifiers that are associated with the lake inlets
         """
         # set up the network if necessary
-        if not self.downstream:
-            self.prepare_downstream()
-        if not self.waterbody_flowline:
+        self.prepare_downstream()
+        if self._wb_indptr is None:
             self.map_waterbodies_to_flowlines()
         flowline_start_ids = set(self.waterbody_flowline[waterbody_start_id])  # one or more
 
         # identify the highest start ids
-        next_down = [self.downstream[id] for id in flowline_start_ids]
-        next_down_flat = {id for id_list in next_down for id in id_list}
+        next_down = _gather_csr(self._dn_indptr, self._dn_indices, self._to_idx(flowline_start_ids))
+        next_down_flat = set(self._idx2id[next_down].tolist())
         highest_flowline_start_ids = flowline_start_ids.difference(next_down_flat)  # lakes may have multiple inlets
         return list(highest_flowline_start_ids)
 
@@ -804,8 +1469,7 @@ class NHDNetwork:
         all_outlets = []
         if not self.lakes_areas:
             self.define_lakes()
-        waterbody_start_ids = list(self.lakes_areas.keys())
-        for waterbody_start_id in waterbody_start_ids:
+        for waterbody_start_id in self.lakes_areas:
             outlets = self.identify_lake_outlets(waterbody_start_id)
             all_outlets.extend(outlets)
         return all_outlets
@@ -817,8 +1481,7 @@ class NHDNetwork:
         all_inlets = []
         if not self.lakes_areas:
             self.define_lakes()
-        waterbody_start_ids = list(self.lakes_areas.keys())
-        for waterbody_start_id in waterbody_start_ids:
+        for waterbody_start_id in self.lakes_areas:
             inlets = self.identify_lake_inlets(waterbody_start_id)
             all_inlets.extend(inlets)
         return all_inlets
@@ -838,12 +1501,10 @@ class NHDNetwork:
         :param str waterbody_start_id: The Permanent_Identifier for the waterbody to be classified.
         :return: The connectivity class label, one of 'Isolated', 'Headwater', 'DrainageLk', 'Drainage.'
         """
-        if not self.upstream:
-            self.prepare_upstream()
-        if not self.downstream:
-            self.prepare_downstream()
-        if not self.waterbody_flowline:
-            self.map_flowlines_to_waterbodies()
+        self.prepare_upstream()
+        self.prepare_downstream()
+        if self._wb_indptr is None:
+            self.map_waterbodies_to_flowlines()
         if not self.tenha_waterbody_ids:
             self.activate_10ha_lake_stops()
             self.deactivate_stops()
@@ -854,40 +1515,73 @@ class NHDNetwork:
             reset_waterbody_stop_ids = self.waterbody_stop_ids
             self.deactivate_stops()
 
+        trace_up, trace_down = self.trace_bidirectional_from_a_waterbody(waterbody_start_id)
+        connclass = self._classify_traces(waterbody_start_id, trace_up, trace_down)
+
+        if reset:
+            self.waterbody_stop_ids = reset_waterbody_stop_ids
+            self.flowline_stop_ids = reset_flowline_stop_ids
+
+        return connclass
+
+    def classify_all_waterbodies(self, waterbody_ids):
+        """
+        Classify the freshwater network connectivity of many waterbodies at once. The classes are the same as for
+        classify_waterbody_connectivity, but the traces come from the batched multi-source traces, run for one chunk
+        of LABEL_CHUNK_SIZE waterbodies at a time, instead of two traces per waterbody.
+
+        :param list waterbody_ids: The Permanent_Identifiers for the waterbodies to be classified.
+        :return: Dictionary with key = waterbody Permanent_Identifier, value = connectivity class label
+        """
+        self.prepare_upstream()
+        self.prepare_downstream()
+        if self._wb_indptr is None:
+            self.map_waterbodies_to_flowlines()
+        if not self.tenha_waterbody_ids:
+            self.activate_10ha_lake_stops()
+            self.deactivate_stops()
+        reset_waterbody_start_ids = self.waterbody_start_ids
+        reset_flowline_stop_ids = self.flowline_stop_ids
+        reset_waterbody_stop_ids = self.waterbody_stop_ids
+        if self.flowline_stop_ids:
+            self.deactivate_stops()
+
+        # only one chunk's traces are held in memory at a time
+        conn_classes = {}
+        unique_ids = list(dict.fromkeys(waterbody_ids))
+        for chunk_start in range(0, len(unique_ids), LABEL_CHUNK_SIZE):
+            self.waterbody_start_ids = unique_ids[chunk_start:chunk_start + LABEL_CHUNK_SIZE]
+            traces_up = self.trace_up_from_waterbody_starts()
+            traces_down = self.trace_down_from_waterbody_starts()
+            for id in self.waterbody_start_ids:
+                conn_classes[id] = self._classify_traces(id, traces_up[id], traces_down[id])
+
+        self.waterbody_start_ids = reset_waterbody_start_ids
+        self.waterbody_stop_ids = reset_waterbody_stop_ids
+        self.flowline_stop_ids = reset_flowline_stop_ids
+        return conn_classes
+
+    def _classify_traces(self, waterbody_start_id, trace_up, trace_down):
+        """
+        Assign the connectivity class for a waterbody from its unimpeded upstream and downstream traces. See
+        classify_waterbody_connectivity for the class definitions.
+        :param str waterbody_start_id: The Permanent_Identifier for the waterbody being classified.
+        :param list trace_up: Upstream trace of the waterbody
+        :param list trace_down: Downstream trace of the waterbody
+        :return: The connectivity class label
+        """
         # Isolated first
-        trace_up = self.trace_up_from_a_waterbody(waterbody_start_id)
-        trace_down = self.trace_down_from_a_waterbody(waterbody_start_id)
         if len(trace_up) == 0 and len(trace_down) == 0 and not self.exclude_intermittent_flow:
             connclass = 'Isolated'
         # otherwise subtract lake's self and internal flowlines, check for 10 ha lakes in trace, and classify
         else:
-            inside_ids = self.waterbody_flowline[waterbody_start_id]
+            inside_ids = list(self.waterbody_flowline[waterbody_start_id])
             inside_ids.append(waterbody_start_id)
             nonself_trace_down = set(trace_down).difference(set(inside_ids))
             nonself_trace_up = set(trace_up).difference(set(inside_ids))
-            tenha_upstream = set(nonself_trace_up).intersection(set(self.tenha_waterbody_ids))
-
-            if len(nonself_trace_up) == 0: # no upstream connectivity
-                if len(nonself_trace_down) > 0:
-                    connclass = 'Headwater'
-                if len(nonself_trace_down) == 0:
-                    connclass = 'Isolated'
-
-            else: # has upstream connectivity
-                if len(nonself_trace_down) == 0: # no downstream connectivity
-                    if tenha_upstream:
-                        connclass = 'TerminalLk'
-                    else:
-                        connclass = 'Terminal'
-                else: # has downstream connectivity (and upstream)
-                    if tenha_upstream:
-                        connclass = 'DrainageLk'
-                    else:
-                        connclass = 'Drainage'
-
-        if reset:
-            self.waterbody_stop_ids = reset_waterbody_stop_ids
-            self.flowline_stop_ids = reset_flowline_stop_ids
+            tenha_upstream = not nonself_trace_up.isdisjoint(self.tenha_waterbody_ids)
+            key = (bool(nonself_trace_up) << 2) | (bool(nonself_trace_down) << 1) | tenha_upstream
+            connclass = CONNECTIVITY_CLASSES[key]
 
         return connclass
 
@@ -908,16 +1602,20 @@ class NHDNetwork:
         if not self.lakes_areas:
             self.define_lakes()
 
-        countable_lakes = {id for id, area in list(self.lakes_areas.items()) if area >= area_threshold}
-        trace_up = set(self.trace_up_from_a_waterbody(waterbody_start_id)) # includes waterbody ids
-        trace_up_other = trace_up.difference({waterbody_start_id})
-        upstream_lakes = countable_lakes.intersection(trace_up_other)
+        trace_up_other = set(self.trace_up_from_a_waterbody(waterbody_start_id)) # includes waterbody ids
+        trace_up_other.discard(waterbody_start_id)
+        # match the trace against the lake population from the smaller side, then apply the area threshold
+        if len(trace_up_other) < len(self.lakes_areas):
+            traced_lakes = (id for id in trace_up_other if id in self.lakes_areas)
+        else:
+            traced_lakes = (id for id in self.lakes_areas if id in trace_up_other)
+        upstream_lakes = [id for id in traced_lakes if self.lakes_areas[id] >= area_threshold]
 
         if result_type == 'list':
-            return list(upstream_lakes)
+            return upstream_lakes
         if result_type == 'count':
             lake_count = len(upstream_lakes)
             return lake_count
         if result_type == 'area_hectares':
-            lake_area = sum([self.lakes_areas[id] for id in upstream_lakes]) * 100 # convert to hectares
+            lake_area = sum(self.lakes_areas[id] for id in upstream_lakes) * 100 # convert to hectares
             return lake_area
\ No newline at end of file
@@ -0,0 +1,103 @@
+# filename: _trace_kernels.py
+# author: Nicole J Smith
+# version: 2.0
+# LAGOS module(s): LOCUS
+# tool type: code module (NOT IN ArcGIS Toolbox)
+#
+# Compiled network tracing kernels used by NHDNetwork. Numba is optional: if it is not installed in the ArcGIS Pro
+# Python environment, HAVE_NUMBA is False and NHDNetwork falls back to its NumPy implementation.
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit that leaves the function as plain Python."""
+        def decorate(func):
+            return func
+        return decorate
+
+
+@njit(cache=True, boundscheck=False)
+def _seed(indptr, indices, sources, visited, queue):
+    """
+    Queue the source nodes and their immediate neighbors, which are always traced regardless of stops.
+    :return: Tuple of (head, tail) queue positions to continue the trace from
+    """
+    tail = 0
+    for i in range(sources.shape[0]):
+        src = sources[i]
+        if not visited[src]:
+            visited[src] = True
+            queue[tail] = src
+            tail += 1
+    head = tail
+    for i in range(head):
+        u = queue[i]
+        for j in range(indptr[u], indptr[u + 1]):
+            v = indices[j]
+            if not visited[v]:
+                visited[v] = True
+                queue[tail] = v
+                tail += 1
+    return head, tail
+
+
+@njit(cache=True, boundscheck=False)
+def _expand(indptr, indices, stop_mask, visited, queue, head, tail):
+    """
+    Queue the unvisited, non-stop neighbors of the node at queue[head].
+    :return: New queue tail
+    """
+    u = queue[head]
+    for j in range(indptr[u], indptr[u + 1]):
+        v = indices[j]
+        if not visited[v] and not stop_mask[v]:
+            visited[v] = True
+            queue[tail] = v
+            tail += 1
+    return tail
+
+
+@njit(cache=True, boundscheck=False)
+def bfs_csr(indptr, indices, sources, stop_mask, visited, queue):
+    """
+    Breadth-first trace over CSR adjacency arrays from one or more source nodes. The sources' immediate neighbors are
+    always traced; beyond that, nodes flagged in stop_mask are not entered.
+    :param numpy.ndarray indptr: int32 CSR row pointer array for the trace direction
+    :param numpy.ndarray indices: int32 CSR neighbor array for the trace direction
+    :param numpy.ndarray sources: int32 network indices of the start nodes
+    :param numpy.ndarray stop_mask: uint8 array over the network index, 1 for stop nodes
+    :param numpy.ndarray visited: Preallocated boolean array over the network index, all False. Filled in place with
+    True for every node in the trace (including the sources).
+    :param numpy.ndarray queue: Preallocated int32 array the size of the network. Each node is queued at most once;
+    on return queue[:count] holds the traced nodes.
+    :return: Number of nodes in the trace
+    """
+    head, tail = _seed(indptr, indices, sources, visited, queue)
+    while head < tail:
+        tail = _expand(indptr, indices, stop_mask, visited, queue, head, tail)
+        head += 1
+    return tail
+
+
+@njit(cache=True, boundscheck=False)
+def bfs_bidir_csr(up_indptr, up_indices, dn_indptr, dn_indices, up_sources, dn_sources, stop_mask,
+                  visited_up, visited_dn, queue_up, queue_dn):
+    """
+    Run the upstream and downstream traces of bfs_csr together, advancing both queues in lock-step so one call
+    covers both directions.
+    :return: Tuple of (upstream count, downstream count); queue_up[:count] and queue_dn[:count] hold the traced nodes
+    """
+    head_up, tail_up = _seed(up_indptr, up_indices, up_sources, visited_up, queue_up)
+    head_dn, tail_dn = _seed(dn_indptr, dn_indices, dn_sources, visited_dn, queue_dn)
+    while head_up < tail_up or head_dn < tail_dn:
+        if head_up < tail_up:
+            tail_up = _expand(up_indptr, up_indices, stop_mask, visited_up, queue_up, head_up, tail_up)
+            head_up += 1
+        if head_dn < tail_dn:
+            tail_dn = _expand(dn_indptr, dn_indices, stop_mask, visited_dn, queue_dn, head_dn, tail_dn)
+            head_dn += 1
+    return tail_up, tail_dn
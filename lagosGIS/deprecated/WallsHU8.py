@@ -3,10 +3,23 @@
 
 import os, re, shutil
 import arcpy
+import numpy as np
 from arcpy import env
 from arcpy.sa import *
 
 
+def same_grid(raster_a, raster_b):
+    """Whether two Raster objects share a spatial reference, cell size, and snap, so their cells line up 1:1."""
+    if raster_a.spatialReference.exportToString() != raster_b.spatialReference.exportToString():
+        return False
+    cell = raster_a.meanCellWidth
+    if not np.isclose(cell, raster_b.meanCellWidth) or not np.isclose(raster_a.meanCellHeight, raster_b.meanCellHeight):
+        return False
+    offsets = [(raster_a.extent.XMin - raster_b.extent.XMin) / cell,
+               (raster_a.extent.YMin - raster_b.extent.YMin) / cell]
+    return np.allclose(offsets, np.round(offsets))
+
+
 def wall(nhd_gdb, rasters_list, outfolder, height = '500',
                 projection = arcpy.SpatialReference(102039)):
     """For one or more HU8s within the same subregion (nhd_gdb variable),
@@ -36,9 +49,26 @@ def wall(nhd_gdb, rasters_list, outfolder, height = '500',
         arcpy.AddMessage('Creating output {0}'.format(out_name))
         env.extent = raster
         elevObject = Raster(raster)
-        walled_ned = Con(IsNull(wallsObject), elevObject, Con(LessThan(elevObject, -58000), elevObject, wallsObject))
+        # the NumPy pass below combines cells by position, so it needs the walls on the DEM's grid. Otherwise let
+        # Spatial Analyst resample through the environments.
+        if not same_grid(elevObject, wallsObject):
+            walled_ned = Con(IsNull(wallsObject), elevObject,
+                             Con(LessThan(elevObject, -58000), elevObject, wallsObject))
+            walled_ned.save(out_name)
+            continue
 
+        # read the walls on the elevation raster's grid (same snap and cell size) and combine them in one pass:
+        # keep the elevation where there is no wall, the elevation is NoData, or it is below -58000
+        lower_left = arcpy.Point(elevObject.extent.XMin, elevObject.extent.YMin)
+        cell_size = elevObject.meanCellWidth
+        elev = arcpy.RasterToNumPyArray(elevObject, nodata_to_value=np.nan).astype(np.float32)
+        walls = arcpy.RasterToNumPyArray(wallsObject, lower_left, elev.shape[1], elev.shape[0],
+                                         nodata_to_value=np.nan)
+        keep_elev = np.isnan(walls) | np.isnan(elev) | (elev < -58000)
+        walled = np.where(keep_elev, elev, walls).astype(np.float32)
+        walled_ned = arcpy.NumPyArrayToRaster(walled, lower_left, cell_size, cell_size, np.nan)
         walled_ned.save(out_name)
+        arcpy.DefineProjection_management(out_name, env.outputCoordinateSystem)
 
     for item in ['huc8_layer', 'wall_lines', 'wall_raster']:
         arcpy.Delete_management(item)
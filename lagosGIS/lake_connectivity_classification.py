@@ -14,7 +14,7 @@ def classify(nhd_gdb, output_table):
     Classifies lakes based on freshwater hydrologic connectivity. The classification is performed twice to obtain both
     the maximum and the permanent-only (intermittent & ephemeral flowlines excluded) connectivity. Additionally, after
     calculating both the maximum and permanent-only connectivity for the lake, it assigns 'Y' or "N' to the
-    lake_connectivity_fluctuates flag. This tool relies on NHDNetwork.classify_waterbody_connectivity.
+    lake_connectivity_fluctuates flag. This tool relies on NHDNetwork.classify_all_waterbodies.
 
     The four lake connectivity classifications:
         Isolated--traces in both directions were empty (no network connectivity)
@@ -43,12 +43,12 @@ def classify(nhd_gdb, output_table):
 
     arcpy.AddMessage("Calculating all connectivity...")
     # calc all connectivity, see NHDNetwork script for details
-    conn_class = {id:nhd_network.classify_waterbody_connectivity(id) for id in waterbody_ids}
+    conn_class = nhd_network.classify_all_waterbodies(waterbody_ids)
 
     # permanent only
     arcpy.AddMessage("Calculating permanent connectivity...")
     nhd_network.drop_intermittent_flow()
-    conn_permanent = {id:nhd_network.classify_waterbody_connectivity(id) for id in waterbody_ids}
+    conn_permanent = nhd_network.classify_all_waterbodies(waterbody_ids)
 
     # make an output table
     arcpy.AddMessage("Saving output...")
@@ -72,22 +72,22 @@ def classify(nhd_gdb, output_table):
         write_id_names.append('nhd_merge_id')
         arcpy.AddField_management(output, 'nhd_merge_id', 'TEXT', field_length=100)
 
-    write_id_map = {r[0]: list(r)
-                    for r in arcpy.da.SearchCursor(nhd_network.waterbody, write_id_names)}
-
-    # write the table
+    # write the table, streaming the ids straight from the waterbody rows (same order as waterbody_ids) into the
+    # output instead of holding an id map for every waterbody
     cursor_fields = write_id_names + insert_fields
-    rows = arcpy.da.InsertCursor(output, cursor_fields)
-
-    for id in waterbody_ids:
-        write_ids = write_id_map[id]
-        if conn_class[id] == conn_permanent[id]:
-            fluctuates = 'N'
-        else:
-            fluctuates = 'Y'
-
-        row = write_ids + [conn_class[id], conn_permanent[id], fluctuates]
-        rows.insertRow(row)
+    with arcpy.da.SearchCursor(nhd_network.waterbody, write_id_names) as id_rows:
+        with arcpy.da.InsertCursor(output, cursor_fields) as rows:
+            for write_ids in id_rows:
+                id = write_ids[0]
+                if id not in conn_class:
+                    continue
+                if conn_class[id] == conn_permanent[id]:
+                    fluctuates = 'N'
+                else:
+                    fluctuates = 'Y'
+
+                row = list(write_ids) + [conn_class[id], conn_permanent[id], fluctuates]
+                rows.insertRow(row)
     return output
 
 
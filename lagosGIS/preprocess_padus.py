@@ -5,11 +5,71 @@
 # tool type: re-usable (ArcGIS Toolbox)
 
 
+import hashlib
 import time
 import arcpy
+import numpy as np
 from arcpy import management as DM
 import lagosGIS
 
+# Inputs with more rows than this keep their intermediates in the scratch geodatabase instead of memory
+MEMORY_ROW_LIMIT = 1000000
+
+
+def _rank(rule, *value_arrays):
+    """
+    Look up the priority number of every class value in one or more arrays.
+    :param dict rule: Dictionary with key = class value, value = priority number (lower is preferred)
+    :param numpy.ndarray value_arrays: Arrays of class values
+    :return: List of integer arrays of priorities, one per value array
+    """
+    keys = np.array(sorted(rule))
+    ranks = np.array([rule[k] for k in keys])
+    ranked = []
+    for values in value_arrays:
+        unknown = set(np.unique(values[~np.isin(values, keys)]).tolist())
+        if unknown:
+            raise KeyError("No priority rule for value(s) {}".format(sorted(unknown)))
+        ranked.append(ranks[np.searchsorted(keys, values)])
+    return ranked
+
+
+def _shape_key(polygon, tolerance):
+    """
+    Hash a polygon so that shapes equal within the XY tolerance get the same key, as DeleteIdentical would group them.
+    Coordinates are snapped to the tolerance grid, and each ring is read from its lowest vertex in a fixed direction,
+    so the starting vertex, ring direction and ring order don't matter.
+    :param arcpy.Polygon polygon: Shape to hash
+    :param float tolerance: XY tolerance of the shape's spatial reference
+    :return: bytes digest
+    """
+    rings = []
+    for part in polygon:
+        ring = []
+        for point in part:
+            # a null point separates the rings of a part
+            if point is None:
+                rings.append(ring)
+                ring = []
+            else:
+                vertex = (round(point.X / tolerance), round(point.Y / tolerance))
+                if not ring or vertex != ring[-1]:
+                    ring.append(vertex)
+        rings.append(ring)
+
+    normalized = []
+    for ring in rings:
+        if len(ring) > 1 and ring[0] == ring[-1]:
+            ring = ring[:-1]
+        if not ring:
+            continue
+        start = ring.index(min(ring))
+        forward = ring[start:] + ring[:start]
+        backward = forward[:1] + forward[:0:-1]
+        normalized.append(tuple(min(forward, backward)))
+    normalized.sort()
+    return hashlib.sha1(repr(normalized).encode()).digest()
+
 
 def preprocess(padus_combined_fc, output_fc):
     """
@@ -26,96 +86,109 @@ def preprocess(padus_combined_fc, output_fc):
     """
 
     # Prep: Select only the fields needed, remove curves (densify) which prevents problems with geometry
-    # that prevents DeleteIdentical based on Shape
-    arcpy.env.workspace = 'in_memory'
-    padus_fields = ['FeatClass', 'Own_Type', 'GAP_Sts', 'IUCN_Cat']
-    padus_select = lagosGIS.select_fields(padus_combined_fc, 'padus_select', padus_fields, convert_to_table=False)
-    arcpy.Densify_edit(padus_select, 'OFFSET', max_deviation = '1 Meters')
-    arcpy.AddMessage('{} union...'.format(time.ctime()))
-
-    # Self-union to create new features from overlapping regions between polygons
-    union = arcpy.Union_analysis([padus_select, padus_select], 'union', 'ALL', cluster_tolerance='1 Meters')
-
-    # Remove full duplicates resulting from self-union before further processing
-    fid1 = 'FID_padus_select'
-    fid2 = 'FID_padus_select_1'
-    padus_fields_1 = padus_fields + [f + '_1' for f in padus_fields]
-    padus_fields_1.extend([fid1, fid2])
-    arcpy.AddMessage('{} delete identical round 1...'.format(time.ctime()))
-    DM.DeleteIdentical(union, padus_fields_1)
-
-    # Setup for new class fields
-    new_fields = ['agency', 'gap', 'iucn', 'merge_flag', 'area_m2']
-    cursor_fields = sorted(padus_fields_1) + new_fields + ['SHAPE@AREA']
-    DM.AddField(union, 'agency', 'TEXT', field_length=5)
-    DM.AddField(union, 'gap', 'TEXT', field_length=1)
-    DM.AddField(union, 'iucn', 'TEXT', field_length=24)
-    DM.AddField(union, 'merge_flag', 'TEXT', field_length=1)
-    DM.AddField(union, 'area_m2', 'DOUBLE')
-
-    # Establish rules for class priority for each polygon
-    # If polygon was an overlapping region, these rules will select which class value is assigned from the multiple
-    # originals, if they were not the same already
-    owner_rule = {'Fee': 1, 'Easement': 2, 'Marine': 3, 'Designation': 4}
-    iucn_rule = {'Ia': 1,
-                 'Ib': 2,
-                 'II': 3,
-                 'III': 4,
-                 'IV': 5,
-                 'V': 6,
-                 'VI': 7,
-                 'Other Conservation Area': 8,
-                 'Unassigned': 9}
-
-    # Calculate the new class values according to the rules above
-    with arcpy.da.UpdateCursor(union, cursor_fields) as cursor:
-        for row in cursor:
-            id1, id2, fc1, fc2, gap1, gap2, iucn1, iucn2, own1, own2, agency, gap, iucn, flag, areacalc, areashp = row
-            flag = 'N'
-            # Take Fee feature class type first, Designation fc type last. Pull owner value from that feature class type
-            if owner_rule[fc1] < owner_rule[fc2]:
-                agency = own1
-            else:
-                agency = own2
-
-            # Take most protected GAP value
-            gap = min([gap1, gap2])
-
-            # Take numbered IUCN over "other" or "unassigned"; use numbers as priority order
-            if iucn_rule[iucn1] < iucn_rule[iucn2]:
-                iucn = iucn1
-            else:
-                iucn = iucn2
-
-            # Set merge flag to 'Y' if any output field contains a value that had to be resolved among multiple
-            # original polygons
-            if fc1 != fc2 or own1 != own2 or gap1 != gap2 or iucn1 != iucn2:
-                flag = 'Y'
-
-            areacalc = areashp
-
-            row = (id1, id2, fc1, fc2, gap1, gap2, iucn1, iucn2, own1, own2, agency, gap, iucn, flag, areacalc, areashp)
-            cursor.updateRow(row)
-
-    # Prep for DeleteIdentical: Dispose of polygons under 4 sq. m (they cause trouble, don't effect
-    # stats enough to bother) and repair geometry on the rest.
-    large_enough = arcpy.Select_analysis(union, 'large_enough', 'area_m2 > 4')
-    arcpy.AddMessage('{} repair...'.format(time.ctime()))
-    DM.RepairGeometry(large_enough)
-
-    # Sort so that merged polygons are highest/retained in DeleteIdentical
-    # Delete identical shapes to end up with just the merged polygons and polygons from non-overlapping regions
-    arcpy.AddMessage('{} sort...'.format(time.ctime()))
-    sorted_fc = DM.Sort(large_enough, 'sorted_fc', [['merge_flag', 'DESCENDING']])
-
-    arcpy.AddMessage('{} delete identical shape...'.format(time.ctime()))
-    DM.DeleteIdentical(sorted_fc, "Shape")
-    output_fields = [fid1, fid2] + new_fields
-    output_fc = lagosGIS.select_fields(sorted_fc, output_fc, output_fields)
-
-    # Clean up
-    for item in [padus_select, union, sorted_fc, large_enough]:
-        DM.Delete(item)
+    # that prevents deleting identical shapes
+    if int(DM.GetCount(padus_combined_fc).getOutput(0)) > MEMORY_ROW_LIMIT:
+        workspace = arcpy.env.scratchGDB
+    else:
+        workspace = 'memory'
+    # Let the overlay and geometry tools that support it use every core. Both settings are restored on exit.
+    with arcpy.EnvManager(workspace=workspace, parallelProcessingFactor='100%'):
+        padus_fields = ['FeatClass', 'Own_Type', 'GAP_Sts', 'IUCN_Cat']
+        padus_select = lagosGIS.select_fields(padus_combined_fc, 'padus_select', padus_fields, convert_to_table=False)
+        arcpy.Densify_edit(padus_select, 'OFFSET', max_deviation = '1 Meters')
+        # Index the densified shapes once so the self-union doesn't have to build its own
+        DM.AddSpatialIndex(padus_select)
+        arcpy.AddMessage('{} union...'.format(time.ctime()))
+
+        # Self-union to create new features from overlapping regions between polygons
+        union_all = arcpy.Union_analysis([padus_select, padus_select], 'union_all', 'ALL', cluster_tolerance='1 Meters')
+
+        # Every overlap piece comes out of the self-union twice, as (A, B) and (B, A) with the same shape. Keep one
+        # input order only so the rest of the processing handles half as many overlap pieces.
+        fid1 = 'FID_padus_select'
+        fid2 = 'FID_padus_select_1'
+        union = arcpy.Select_analysis(union_all, 'union', '{} <= {}'.format(fid1, fid2))
+        DM.Delete(union_all)
+
+        # Remove full duplicates resulting from self-union before further processing
+        class_fields = padus_fields + [f + '_1' for f in padus_fields]
+        padus_fields_1 = class_fields + [fid1, fid2]
+        arcpy.AddMessage('{} delete identical round 1...'.format(time.ctime()))
+        DM.DeleteIdentical(union, padus_fields_1)
+
+        # Establish rules for class priority for each polygon
+        # If polygon was an overlapping region, these rules will select which class value is assigned from the multiple
+        # originals, if they were not the same already
+        owner_rule = {'Fee': 1, 'Easement': 2, 'Marine': 3, 'Designation': 4}
+        iucn_rule = {'Ia': 1,
+                     'Ib': 2,
+                     'II': 3,
+                     'III': 4,
+                     'IV': 5,
+                     'V': 6,
+                     'VI': 7,
+                     'Other Conservation Area': 8,
+                     'Unassigned': 9}
+
+        # Calculate the new class values according to the rules above, for all polygons at once
+        oid_field = arcpy.Describe(union).OIDFieldName
+        arr = arcpy.da.FeatureClassToNumPyArray(union, ['OID@'] + class_fields + ['SHAPE@AREA'])
+        fc1, fc2 = arr['FeatClass'], arr['FeatClass_1']
+        own1, own2 = arr['Own_Type'], arr['Own_Type_1']
+        gap1, gap2 = arr['GAP_Sts'], arr['GAP_Sts_1']
+        iucn1, iucn2 = arr['IUCN_Cat'], arr['IUCN_Cat_1']
+
+        new_fields = ['agency', 'gap', 'iucn', 'merge_flag', 'area_m2']
+        resolved = np.empty(len(arr), dtype=[('union_oid', '<i4'), ('agency', '<U5'), ('gap', '<U1'), ('iucn', '<U24'),
+                                             ('merge_flag', '<U1'), ('area_m2', '<f8')])
+        resolved['union_oid'] = arr['OID@']
+        fc1_rank, fc2_rank = _rank(owner_rule, fc1, fc2)
+        iucn1_rank, iucn2_rank = _rank(iucn_rule, iucn1, iucn2)
+        # Take Fee feature class type first, Designation fc type last. Pull owner value from that feature class type
+        resolved['agency'] = np.where(fc1_rank < fc2_rank, own1, own2)
+        # Take most protected GAP value
+        resolved['gap'] = np.where(gap1 <= gap2, gap1, gap2)
+        # Take numbered IUCN over "other" or "unassigned"; use numbers as priority order
+        resolved['iucn'] = np.where(iucn1_rank < iucn2_rank, iucn1, iucn2)
+        # Set merge flag to 'Y' if any output field contains a value that had to be resolved among multiple
+        # original polygons
+        resolved['merge_flag'] = np.where((fc1 != fc2) | (own1 != own2) | (gap1 != gap2) | (iucn1 != iucn2), 'Y', 'N')
+        resolved['area_m2'] = arr['SHAPE@AREA']
+        arcpy.da.ExtendTable(union, oid_field, resolved, 'union_oid')
+
+        # Prep for deleting identical shapes: Dispose of polygons under 4 sq. m (they cause trouble, don't effect
+        # stats enough to bother) and repair geometry on the rest.
+        with arcpy.da.UpdateCursor(union, ['area_m2']) as cursor:
+            for row in cursor:
+                if row[0] <= 4:
+                    cursor.deleteRow()
+        arcpy.AddMessage('{} repair...'.format(time.ctime()))
+        DM.RepairGeometry(union)
+
+        # Delete identical shapes (within the XY tolerance) to end up with just the merged polygons and polygons from
+        # non-overlapping regions. For each shape keep the first merged polygon, or the first polygon if none of them
+        # were merged.
+        arcpy.AddMessage('{} delete identical shape...'.format(time.ctime()))
+        tolerance = arcpy.Describe(union).spatialReference.XYTolerance
+        keep_by_shape = {}
+        with arcpy.da.SearchCursor(union, ['OID@', 'SHAPE@', 'merge_flag']) as cursor:
+            for oid, shape, merge_flag in cursor:
+                shape_hash = _shape_key(shape, tolerance)
+                kept = keep_by_shape.get(shape_hash)
+                if kept is None or (merge_flag == 'Y' and kept[1] != 'Y'):
+                    keep_by_shape[shape_hash] = (oid, merge_flag)
+        keep_oids = {oid for oid, merge_flag in keep_by_shape.values()}
+        del keep_by_shape
+        with arcpy.da.UpdateCursor(union, ['OID@']) as cursor:
+            for row in cursor:
+                if row[0] not in keep_oids:
+                    cursor.deleteRow()
+        output_fields = [fid1, fid2] + new_fields
+        output_fc = lagosGIS.select_fields(union, output_fc, output_fields)
+
+        # Clean up
+        for item in [padus_select, union]:
+            DM.Delete(item)
     return output_fc
 
 
@@ -5,13 +5,30 @@
 # tool type: re-usable (NOT in ArcGIS Toolbox)
 
 
+import concurrent.futures
 import csv
+import functools
+import importlib
+import multiprocessing
 import os
+import re
+import sys
 import time
 import arcpy
 import lagosGIS
 
 ARG_NUMBERS = ['Arg1', 'Arg2', 'Arg3', 'Arg4', 'Arg5', 'Arg6', 'Arg7', 'Arg8']
+RAW_STRING = re.compile(r"^r'(.*)'$", re.DOTALL)
+BOOLEAN_STRINGS = {'TRUE': True, 'FALSE': False}
+
+# Define valid CSV file header
+# Line is sequential integer identifying row number
+# Function is function call without parenthesis i.e. "lagosGIS.lake_density"
+# Arg1-Arg8 provide the arguments to the function, leave missing after last argument needed
+# Output repeats output path/location argument (which has variable position)
+# CSV specifies location for CSV export file
+CSV_HEADER = ['Line', 'Function', 'Arg1', 'Arg2', 'Arg3', 'Arg4', 'Arg5', 'Arg6', 'Arg7', 'Arg8', 'Output', 'CSV']
+COLUMNS = {name: i for i, name in enumerate(CSV_HEADER)}
 
 
 def cook_string(input):
@@ -20,18 +37,113 @@ def cook_string(input):
     :param input: A string with contents that include r'[text'.
     :return: String
     """
-    if input.startswith('r\'') and input.endswith('\''):
-        result = input[2:-1]
-    else:
-        result = input
-    if result.upper() == 'TRUE':
-        result = True
-    elif result.upper() == 'FALSE':
-        result = False
-    return result
-
-
-def read_job_control(job_control_csv, start_line=-1, end_line=-1, validate=False, validate_args=[]):
+    raw = RAW_STRING.match(input)
+    result = raw.group(1) if raw else input
+    return BOOLEAN_STRINGS.get(result.upper(), result)
+
+
+@functools.lru_cache(maxsize=8)
+def _read_job_lines(job_control_csv, mtime, start_line=-1, end_line=-1):
+    """
+    Reads and checks the rows of a job control file, stopping once the requested rows have been read. Results are
+    cached, so validating and then running the same file only parses it once; the modification time is part of the
+    key so an edited file is read again.
+    :param job_control_csv: The path to the job control CSV file
+    :param mtime: The modification time of the file, from os.path.getmtime
+    :param start_line: (Optional) The row number to start from, or a tuple of Line values to read. Default reads
+    from the first row.
+    :param end_line: (Optional) The row number to end at. Default reads to the end of the file.
+    :return: Tuple of rows, each a list of values in CSV_HEADER column order (see COLUMNS)
+    """
+    with open(job_control_csv) as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, [])
+        if set(header) != set(CSV_HEADER):
+            raise Exception("""CSV file is not in the required format. Please provide a file with the header as follows:
+                            \n{}""".format(CSV_HEADER))
+        # Skip blank rows and fill in short ones, as csv.DictReader would
+        order = None if header == CSV_HEADER else [header.index(name) for name in CSV_HEADER]
+        rows = (row + [''] * (len(header) - len(row)) for row in reader if row)
+        if order:
+            rows = ([row[i] for i in order] for row in rows)
+
+        line_col = COLUMNS['Line']
+        lines = []
+        if isinstance(start_line, tuple):
+            wanted = set(start_line)
+            for line in rows:
+                if int(line[line_col]) in wanted:
+                    lines.append(line)
+                    if len(lines) == len(wanted):
+                        break
+        else:
+            for i, line in enumerate(rows, 1):
+                if 0 < end_line < i:
+                    break
+                if i >= start_line:
+                    lines.append(line)
+    return tuple(lines)
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_function(function):
+    """
+    Looks up the function named in a job control file.
+    :param function: Dotted function name without parenthesis i.e. "lagosGIS.lake_density"
+    :return: The function object
+    """
+    module_name, _, function_name = function.rpartition('.')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def _output_workspace(output):
+    """
+    Finds the geodatabase an output is written to, so that jobs sharing a geodatabase (including outputs in different
+    feature datasets of it) can be kept in one process.
+    :param output: Output path from a job control row
+    :return: Path of the enclosing .gdb or .sde workspace, or the output's folder if it is in neither
+    """
+    workspace = output
+    while workspace:
+        if os.path.splitext(workspace)[1].lower() in ('.gdb', '.sde'):
+            return workspace
+        parent = os.path.dirname(workspace)
+        if parent == workspace:
+            break
+        workspace = parent
+    return os.path.dirname(output)
+
+
+def _init_worker():
+    """Starts each worker process from the default geoprocessing environment settings."""
+    arcpy.ResetEnvironments()
+
+
+def _run_jobs(jobs):
+    """
+    Runs job control calls one after another and exports each result to CSV.
+    :param jobs: List of (function, args, output, csv_path) tuples
+    :return: List of exception messages from the jobs that failed
+    """
+    exceptions = []
+    for function, args, output, csv_path in jobs:
+        print(time.ctime())
+        print("{}({})".format(function, ', '.join(repr(arg) for arg in args)))
+        try:
+            _resolve_function(function)(*args)
+            out_folder = os.path.dirname(csv_path)
+            lagosGIS.export_to_csv(output, out_folder, rename_fields=False)
+        except Exception as e:
+            exceptions.append(str(e))
+            print('WARNING: {}'.format(e))
+
+        # Keep in_memory and memory workspaces from carrying over to the next call
+        arcpy.Delete_management('in_memory')
+        arcpy.Delete_management('memory')
+    return exceptions
+
+
+def read_job_control(job_control_csv, start_line=-1, end_line=-1, validate=False, validate_args=[], processes=1):
     """
     Reads a job control file with the following CSV format: First column contains function name to run. Columns contain
     arguments to use, in order.
@@ -42,17 +154,13 @@ def read_job_control(job_control_csv, start_line=-1, end_line=-1, validate=False
     :param validate: (Optional) Boolean. Whether to validate the inputs only, do not actually execute commands.
     :param validate_args: (Optional) If validate=True, provide a list of the argument labels to validate. Use
     ['Arg1', 'Arg2', 'Arg3'] etc.
+    :param processes: (Optional) Number of worker processes to run jobs in. Jobs writing to the same geodatabase
+    always run one after another in the same process. Default runs every job in this process, in file order. Workers
+    are started with the spawn method, so a script calling this with processes > 1 must do so under an
+    if __name__ == '__main__': guard; it will not work from the ArcGIS Pro Python window.
     :return: None
     """
 
-    # Define valid CSV file header
-    # Line is sequential integer identifying row number
-    # Function is function call without parenthesis i.e. "lagosGIS.lake_density"
-    # Arg1-Arg8 provide the arguments to the function, leave missing after last argument needed
-    # Output repeats output path/location argument (which has variable position)
-    # CSV specifies location for CSV export file
-    csv_header = ['Line', 'Function', 'Arg1', 'Arg2', 'Arg3', 'Arg4', 'Arg5', 'Arg6', 'Arg7', 'Arg8', 'Output', 'CSV']
-
     # Validate inputs
     if validate and not validate_args:
         raise Exception("Provide validation arguments keyword as a list of 'Arg1', 'Arg2', etc.")
@@ -61,71 +169,68 @@ def read_job_control(job_control_csv, start_line=-1, end_line=-1, validate=False
             raise Exception("Provide validation arguments keyword as a list of 'Arg1', 'Arg2', etc.")
 
     # Read CSV and filter for line numbers requested in this batch run
-    with open(job_control_csv) as csv_file:
-        reader = csv.DictReader(csv_file)
-        lines = [line for line in reader]
-        if not list(lines[0].keys()).sort() == csv_header.sort():
-            raise Exception("""CSV file is not in the required format. Please provide a file with the header as follows:
-                            \n{}""".format(csv_header))
-        if isinstance(start_line, int) and \
-                (start_line > 0 or end_line > 0):
-            lines = lines[start_line-1:end_line]
-        elif isinstance(start_line, list):
-            lines = [line for line in lines if int(line['Line']) in start_line]
+    if isinstance(start_line, list):
+        start_line = tuple(start_line)
+    lines = _read_job_lines(job_control_csv, os.path.getmtime(job_control_csv), start_line, end_line)
+
+    # Many rows share the same inputs and output geodatabase, so only ask arcpy about each path once
+    exists_cache = {}
+
+    def exists(path):
+        if path not in exists_cache:
+            exists_cache[path] = arcpy.Exists(path)
+        return exists_cache[path]
 
     # Read the table and compose the calls
     calls = []
     outputs = []
     csv_paths = []
+    arg_cols = [COLUMNS[arg] for arg in ARG_NUMBERS]
+    validate_cols = [COLUMNS[arg] for arg in validate_args]
     for line in lines:
-        function = cook_string(line['Function'])
-        args = []
+        function = cook_string(line[COLUMNS['Function']])
         # find last non-empty argument
-        arg_vals = [line['Arg{}'.format(i)] for i in range(1,9)]
-        args_length = arg_vals.index(next(arg for arg in reversed(arg_vals) if arg)) + 1
-        for i in range(args_length):
-            input_arg = line['Arg{}'.format(i+1)]
-            if input_arg:
-                args.append(cook_string(input_arg))
-            else:
-                args.append('')
+        args_length = next((i for i in range(len(arg_cols), 0, -1) if line[arg_cols[i-1]]), 0)
+        args = [cook_string(line[col]) for col in arg_cols[:args_length]]
 
-        output = cook_string(line['Output'])
-        csv_path = cook_string(line['CSV'])
+        output = cook_string(line[COLUMNS['Output']])
+        csv_path = cook_string(line[COLUMNS['CSV']])
         outputs.append(output)
         csv_paths.append(csv_path)
-        formatted_args = ','.join(["r'{}'".format(arg) if isinstance(arg, str) else str(arg) for arg in args])
-        call = "{}({})".format(function, formatted_args)
-        calls.append(call)
+        calls.append((function, args))
 
         # validate (optional)
-        for arg in validate_args:
-            check_item = cook_string(line[arg])
-            if check_item and not arcpy.Exists(check_item):
+        for col in validate_cols:
+            check_item = cook_string(line[col])
+            if check_item and not exists(check_item):
                 print('WARNING: {} does not exist.'.format(check_item))
 
     # Call each tool and export the result to CSV
     if not validate:
-        exceptions = []
-        for call, output, csv_path in zip(calls, outputs, csv_paths):
-            output_dir = os.path.dirname(output)
-            if not arcpy.Exists(output_dir):
+        jobs = []
+        scheduled = set()
+        for (function, args), output, csv_path in zip(calls, outputs, csv_paths):
+            if not exists(os.path.dirname(output)):
                 raise Exception("Provide a valid geodatabase for the output.")
-            if not arcpy.Exists(output):
-                print(time.ctime())
-                print(call)
-                try:
-                    eval(call)
-                    out_folder = os.path.dirname(csv_path)
-                    lagosGIS.export_to_csv(output, out_folder, rename_fields=False)
-                except Exception as e:
-                    exceptions.append(e.message)
-                    print('WARNING: {}'.format(e.message))
-            else:
+            if output in scheduled or exists(output):
                 print("{} already exists.".format(output))
-
-            # Keep in_memory workspace from carrying over to the next call
-            arcpy.Delete_management('in_memory')
+            else:
+                scheduled.add(output)
+                jobs.append((function, args, output, csv_path))
+
+        if processes > 1:
+            jobs_by_gdb = {}
+            for job in jobs:
+                jobs_by_gdb.setdefault(_output_workspace(job[2]), []).append(job)
+            # inside ArcGIS Pro sys.executable is ArcGISPro.exe, so point the workers at the environment's python.exe
+            context = multiprocessing.get_context('spawn')
+            if os.name == 'nt':
+                context.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                                        initializer=_init_worker) as executor:
+                exceptions = [emsg for result in executor.map(_run_jobs, jobs_by_gdb.values()) for emsg in result]
+        else:
+            exceptions = _run_jobs(jobs)
 
         # Finish
         print("ALL EXCEPTION MESSAGES FROM THIS RUN:----------------")
@@ -213,7 +213,7 @@ def revise_hydrodem(nhdplus_gdb, hydrodem_raster, filldepth_raster, lagos_catsee
     network = NHDNetwork(nhdplus_gdb)
     waterbody_ids = network.define_lakes(strict_minsize=True, force_lagos=True).keys()
     arcpy.AddMessage("Identifying sink lakes...")
-    lake_conn_classes = {id:network.classify_waterbody_connectivity(id) for id in waterbody_ids}
+    lake_conn_classes = network.classify_all_waterbodies(waterbody_ids)
     sink_lake_ids = [k for k,v in lake_conn_classes.items() if v in ('Isolated', 'TerminalLk', 'Terminal')]
     sink_lakes_query = 'Permanent_Identifier IN ({})'.format(
         ','.join(['\'{}\''.format(id) for id in sink_lake_ids]))
@@ -88,7 +88,7 @@ def calc_watershed_subtype(nhd_gdb, interlake_fc, fits_naming_standard=True):
     # Step 4: Calculate sub-types
 
     def label_subtype(id, trace, equalsnetwork):
-        inside_ids = nhd_network.waterbody_flowline[id]
+        inside_ids = list(nhd_network.waterbody_flowline[id])
         inside_ids.append(id)
         nonself_trace_up = set(trace).difference(set(inside_ids))
         if not nonself_trace_up:
@@ -5,17 +5,50 @@
 # tool type: re-usable (ArcGIS Toolbox)
 
 import csv
+import functools
 import os
 import arcpy
+import numpy as np
 from arcpy import management as DM
 from arcpy import env
-from collections import defaultdict
 
-import lagosGIS
+# Zonal statistics computed for continuous rasters. Elevation outputs keep the mean, min, max, and sd only, so skip the
+# histogram-based statistics (median, majority, minority, variety) that 'ALL' would also calculate. Zonal Statistics as
+# Table is only given several statistics at once on ArcGIS Pro 3.1 and later; earlier versions still calculate 'ALL'.
+CONTINUOUS_STATISTICS = 'MEAN'
+if tuple(int(v) for v in arcpy.GetInstallInfo()['Version'].split('.')[:2]) >= (3, 1):
+    ELEVATION_STATISTICS = 'MINIMUM;MAXIMUM;MEAN;STD'
+else:
+    ELEVATION_STATISTICS = 'ALL'
+
+# ListFields Field.type values and the matching field_type keywords for AddFields
+FIELD_TYPE_KEYWORDS = {'String': 'TEXT', 'SmallInteger': 'SHORT', 'Integer': 'LONG', 'Single': 'FLOAT',
+                       'Double': 'DOUBLE', 'Date': 'DATE', 'GUID': 'GUID'}
+
+
+@functools.lru_cache(maxsize=32)
+def _load_subgroup_mapping(geo_file, mtime, rename_tag):
+    """
+    Reads the subgroup code mappings for one variable from geo_metric_provenance.csv. Results are cached so batches
+    summarizing the same variable only parse the file once; the modification time is part of the key so an edited
+    file is read again.
+    :param geo_file: Path to geo_metric_provenance.csv
+    :param mtime: The modification time of the file, from os.path.getmtime
+    :param rename_tag: The variable name tag; rows whose main_feature is contained in it are used
+    :return: Tuple of (subgroup_original_code, subgroup) pairs
+    """
+    with open(geo_file) as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        feature_i = header.index('main_feature')
+        code_i = header.index('subgroup_original_code')
+        subgroup_i = header.index('subgroup')
+        return tuple((row[code_i], row[subgroup_i]) for row in reader
+                     if row and row[feature_i] and row[feature_i] in rename_tag)
 
 
 def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_table='',
-         rename_tag='', units=''):
+         rename_tag='', units='', zone_raster=''):
     """
     Calculates the mean raster value in each zone or summarizes categorical raster data as a percent of each zone
     depending on the input raster type.
@@ -29,17 +62,19 @@ def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_ta
     the location of the overlapping vs. non-overlapping identifier mapping table.
     :param rename_tag: (Optional) A variable name to include in all output columns
     :param units: (Optional) A units suffix to append to all output columns
+    :param zone_raster: (Optional) zone_fc already converted to raster on the common grid with PolygonToRaster. Batches
+    summarizing many rasters for the same polygon zones can convert them once and pass the result here.
     :return: Out_table location
     """
 
     orig_env = env.workspace
-    env.workspace = 'in_memory'
+    env.workspace = 'memory'
     arcpy.SetLogHistory(False)
     arcpy.CheckOutExtension("Spatial")
 
     # ---DEFINE FUNCTIONS-----------------------------------------------------------------------------------------
     def stats_area_table(zone_fc=zone_fc, zone_field=zone_field, in_value_raster=in_value_raster,
-                         out_table=out_table, is_thematic=is_thematic):
+                         out_table=out_table, is_thematic=is_thematic, zone_raster=zone_raster):
         """
         Runs Zonal Statistics as Table for continuous data or Tabulate Area for thematic/categorical data and refines
         the output to prepare the table for being included in LAGOS-US.
@@ -56,39 +91,35 @@ def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_ta
             """Makes a nicer output for this tool. Rename some fields, drop unwanted
                 ones, calculate percentages using raster AREA before deleting that
                 field."""
+            fields_by_name = {f.name.upper(): f for f in arcpy.ListFields(t)}
             if is_thematic:
-                value_fields = arcpy.ListFields(t, "VALUE*")
+                value_fields = [f for name, f in fields_by_name.items() if name.startswith('VALUE')]
                 pct_fields = ['{}_pct'.format(f.name) for f in
                               value_fields]  # VALUE_41_pct, etc. Field can't start with number.
 
-                # add all the new fields needed
-                for f, pct_field in zip(value_fields, pct_fields):
-                    arcpy.AddField_management(t, pct_field, f.type)
+                # calculate the percents for all rows and value fields at once, then add them as new fields
+                value_names = [f.name for f in value_fields]
+                arr = arcpy.da.TableToNumPyArray(t, ['OID@', 'AREA'] + value_names)
+                pct_struct = np.empty(len(arr), dtype=[('oid_join', '<i4')] + [(pf, '<f8') for pf in pct_fields])
+                pct_struct['oid_join'] = arr['OID@']
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    for vf, pf in zip(value_names, pct_fields):
+                        pct_struct[pf] = 100.0 * arr[vf] / arr['AREA']
+                arcpy.da.ExtendTable(t, arcpy.Describe(t).OIDFieldName, pct_struct, 'oid_join')
 
-                # calculate the percents
-                cursor_fields = ['AREA'] + [f.name for f in value_fields] + pct_fields
-                uCursor = arcpy.da.UpdateCursor(t, cursor_fields)
-                for uRow in uCursor:
-                    # unpacks area + 3 tuples of the right fields for each, no matter how many there are
-                    vf_i_end = len(value_fields) + 1
-                    pf_i_end = vf_i_end + len(pct_fields)
+                # a zone with no area has no percents, write null rather than inf/nan
+                if (arr['AREA'] == 0).any():
+                    with arcpy.da.UpdateCursor(t, pct_fields, 'AREA = 0') as u_cursor:
+                        for row in u_cursor:
+                            u_cursor.updateRow([None] * len(pct_fields))
 
-                    # pct_values and ha_values are both null at this point but unpack for clarity
-                    area, value_values, pct_values = uRow[0], uRow[1:vf_i_end], uRow[vf_i_end:pf_i_end]
-                    new_pct_values = [100 * vv / area for vv in value_values]
-                    new_row = [area] + value_values + new_pct_values
-                    uCursor.updateRow(new_row)
-
-                for vf in value_fields:
-                    arcpy.DeleteField_management(t, vf.name)
+                arcpy.DeleteField_management(t, value_names)
 
             arcpy.AlterField_management(t, 'COUNT', 'CELL_COUNT')
             drop_fields = ['ZONE_CODE', 'COUNT', 'AREA', 'MAJORITY', 'MEDIAN', 'MINORITY', 'RANGE', 'SUM', 'VARIETY']
-            for df in drop_fields:
-                try:
-                    arcpy.DeleteField_management(t, df)
-                except:
-                    continue
+            drop_existing = [df for df in drop_fields if df in fields_by_name and df != 'COUNT']  # COUNT renamed above
+            if drop_existing:
+                arcpy.DeleteField_management(t, drop_existing)
 
         # SETUP---------------------------------------------------------------------------------------------------
         # Set up environments for alignment between zone raster and theme raster
@@ -100,21 +131,30 @@ def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_ta
         env.snapRaster = common_grid
         env.cellSize = common_grid
         env.extent = zone_fc
+        # Zonal Statistics as Table and Tabulate Area tile the rasters internally; let them spread tiles over all cores
+        env.parallelProcessingFactor = '100%'
 
-        # Convert zones to raster if provided as polygon feature class
+        # Convert zones to raster if provided as polygon feature class, unless the caller already converted them
+        temp_items = ['temp_zonal_table']
         zone_desc = arcpy.Describe(zone_fc)
-        zone_raster = 'convertraster'
         if zone_desc.dataType not in ['RasterDataset', 'RasterLayer']:
-            zone_raster = arcpy.PolygonToRaster_conversion(zone_fc, zone_field, zone_raster, 'CELL_CENTER',
-                                                           cellsize=env.cellSize)
+            if not zone_raster:
+                zone_raster = arcpy.PolygonToRaster_conversion(zone_fc, zone_field, 'convertraster', 'CELL_CENTER',
+                                                               cellsize=env.cellSize)
+                temp_items.append('convertraster')
             print('cell size is {}'.format(env.cellSize))
             zone_size = int(env.cellSize)
         else:
             zone_raster = zone_fc
-            zone_size = min(arcpy.Describe(zone_raster).meanCellHeight, arcpy.Describe(zone_raster).meanCellWidth)
-            raster_size = min(arcpy.Describe(in_value_raster).meanCellHeight, arcpy.Describe(in_value_raster).meanCellWidth)
+            zone_size = min(zone_desc.meanCellHeight, zone_desc.meanCellWidth)
+            value_desc = arcpy.Describe(in_value_raster)
+            raster_size = min(value_desc.meanCellHeight, value_desc.meanCellWidth)
             env.cellSize = min([zone_size, raster_size])
             print('cell size is {}'.format(env.cellSize))
+        # area of one processing cell, read from the environment once. Thematic cell counts use whole-unit cell sides.
+        cell_size = float(env.cellSize)
+        cell_area = cell_size * cell_size
+        count_cell_area = int(cell_size) * int(cell_size)
 
         # I tested and there is no need to resample the raster being summarized. It will be resampled correctly
         # internally in the following tool given that the necessary environments are set above (cell size, snap).
@@ -124,11 +164,12 @@ def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_ta
         if not is_thematic:
             arcpy.AddMessage("Calculating Zonal Statistics...")
             if 'elevation' in rename_tag:
-                temp_entire_table = arcpy.sa.ZonalStatisticsAsTable(zone_raster, zone_field, in_value_raster,
-                                                                    'temp_zonal_table', 'DATA', 'ALL')
+                zonal_statistics = ELEVATION_STATISTICS
             else:
-                temp_entire_table = arcpy.sa.ZonalStatisticsAsTable(zone_raster, zone_field, in_value_raster,
-                                                                'temp_zonal_table', 'DATA', 'MEAN')
+                zonal_statistics = CONTINUOUS_STATISTICS
+            temp_entire_table = arcpy.sa.ZonalStatisticsAsTable(zone_raster, zone_field, in_value_raster,
+                                                                'temp_zonal_table', 'DATA', zonal_statistics)
+            temp_oid_field = arcpy.Describe(temp_entire_table).OIDFieldName
 
 
         # POST-PROCESSING OUTPUT-----------------------------------------------------------------------------------
@@ -138,6 +179,7 @@ def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_ta
             arcpy.AddMessage("Tabulating areas...")
             temp_entire_table = arcpy.sa.TabulateArea(zone_raster, zone_field, in_value_raster, 'Value',
                                                       'temp_area_table', processing_cell_size = env.cellSize)
+            temp_oid_field = arcpy.Describe(temp_entire_table).OIDFieldName
             # TabulateArea capitalizes the zone for some annoying reason and ArcGIS is case-insensitive to field names
             # so we have this work-around:
             zone_field_t = '{}_t'.format(zone_field)
@@ -149,78 +191,67 @@ def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_ta
 
             # replaces join to Zonal Stats in previous versions of tool
             # no joining, just calculate the area/count from what's produced by TabulateArea
-            arcpy.AddField_management(temp_entire_table, 'AREA', 'DOUBLE')
-            arcpy.AddField_management(temp_entire_table, 'COUNT', 'DOUBLE')
-
-            cursor_fields = ['AREA', 'COUNT']
             value_fields = [f.name for f in arcpy.ListFields(temp_entire_table, 'VALUE*')]
-            cursor_fields.extend(value_fields)
-            with arcpy.da.UpdateCursor(temp_entire_table, cursor_fields) as uCursor:
-                for uRow in uCursor:
-                    area, count, value_fields = uRow[0], uRow[1], uRow[2:]
-                    area = sum(value_fields)
-                    count = round(area / (int(env.cellSize) * int(env.cellSize)), 0)
-                    new_row = [area, count] + value_fields
-                    uCursor.updateRow(new_row)
+            arr = arcpy.da.TableToNumPyArray(temp_entire_table, ['OID@'] + value_fields)
+            area_count = np.zeros(len(arr), dtype=[('oid_join', '<i4'), ('AREA', '<f8'), ('COUNT', '<f8')])
+            area_count['oid_join'] = arr['OID@']
+            for vf in value_fields:
+                area_count['AREA'] += arr[vf]
+            area_count['COUNT'] = np.round(area_count['AREA'] / count_cell_area)
+            arcpy.da.ExtendTable(temp_entire_table, temp_oid_field, area_count, 'oid_join')
 
         arcpy.AddMessage("Refining output table...")
 
-        arcpy.AddField_management(temp_entire_table, 'datacoveragepct', 'DOUBLE')
-        arcpy.AddField_management(temp_entire_table, 'ORIGINAL_COUNT', 'LONG')
-
         # calculate datacoveragepct by comparing to original areas in zone raster
         # alternative to using JoinField, which is prohibitively slow if zones exceed hu12 count
-        zone_raster_dict = {row[0]: row[1] for row in arcpy.da.SearchCursor(zone_raster, [zone_field, 'Count'])}
-        temp_entire_table_dict = {row[0]: row[1] for row in
-                                  arcpy.da.SearchCursor(temp_entire_table, [zone_field, 'COUNT'])}
+        zone_counts = arcpy.da.TableToNumPyArray(zone_raster, [zone_field, 'Count'])
+        zone_raster_dict = dict(zip(zone_counts[zone_field].tolist(), zone_counts['Count'].tolist()))
+        summarized = arcpy.da.TableToNumPyArray(temp_entire_table, ['OID@', zone_field, 'COUNT'])
+
+        # line up each summarized zone with its original count in the zone raster
+        zone_order = np.argsort(zone_counts[zone_field])
+        match = np.searchsorted(zone_counts[zone_field], summarized[zone_field], sorter=zone_order)
+        match = zone_order[np.minimum(match, len(zone_order) - 1)]
+        missing = zone_counts[zone_field][match] != summarized[zone_field]
+        if missing.any():
+            raise KeyError(summarized[zone_field][missing][0])
+        count_orig = zone_counts['Count'][match]
 
-        sum_cell_area = float(env.cellSize) * float(env.cellSize)
         orig_cell_area = zone_size * zone_size
 
-        with arcpy.da.UpdateCursor(temp_entire_table, [zone_field, 'datacoveragepct', 'ORIGINAL_COUNT']) as cursor:
-            for uRow in cursor:
-                key_value, data_pct, count_orig = uRow
-                count_orig = zone_raster_dict[key_value]
-                if key_value in temp_entire_table_dict:
-                    count_summarized = temp_entire_table_dict[key_value]
-                    data_pct = 100 * float((count_summarized * sum_cell_area) / (count_orig * orig_cell_area))
-                else:
-                    data_pct = None
-                cursor.updateRow((key_value, data_pct, count_orig))
+        coverage = np.empty(len(summarized), dtype=[('oid_join', '<i4'), ('datacoveragepct', '<f8'),
+                                                    ('ORIGINAL_COUNT', '<i4')])
+        coverage['oid_join'] = summarized['OID@']
+        coverage['datacoveragepct'] = 100 * (summarized['COUNT'] * cell_area) / (count_orig * orig_cell_area)
+        coverage['ORIGINAL_COUNT'] = count_orig
+        arcpy.da.ExtendTable(temp_entire_table, temp_oid_field, coverage, 'oid_join')
 
         # Refine the output
         refine_zonal_output(temp_entire_table)
 
         # in order to add vector capabilities back, need to do something with this
         # right now we just can't fill in polygon zones that didn't convert to raster in our system
-        stats_result = lagosGIS.one_in_one_out(temp_entire_table, zone_fc, zone_field, out_table)
-
-        # Convert "datacoveragepct" and "ORIGINAL_COUNT" values to 0 for zones with no metrics calculated
-        with arcpy.da.UpdateCursor(out_table,
-                                   [zone_field, 'datacoveragepct', 'ORIGINAL_COUNT', 'CELL_COUNT']) as u_cursor:
-            for row in u_cursor:
-                # data_coverage pct to 0
-                if row[1] is None:
-                    row[1] = 0
-                # original count filled in if a) zone outside raster bounds or b) zone too small to be rasterized
-                if row[2] is None:
-                    if row[0] in zone_raster_dict:
-                        row[2] = zone_raster_dict[row[0]]
-                    else:
-                        row[2] = 0
-                # cell count set to 0
-                if row[3] is None:
-                    row[3] = 0
-                u_cursor.updateRow(row)
-
-        # count whether all zones got an output record or not)
-        out_count = int(arcpy.GetCount_management(temp_entire_table).getOutput(0))
-        in_count = int(arcpy.GetCount_management(zone_fc).getOutput(0))
-        count_diff = in_count - out_count
+        # Like lagosGIS.one_in_one_out, add a row for every zone with no metrics calculated, but fill it in as it is
+        # inserted: datacoveragepct and CELL_COUNT are 0, and ORIGINAL_COUNT is filled in if a) zone outside raster
+        # bounds or b) zone too small to be rasterized. Rows are appended in zone_fc order.
+        original_zones = [r[0] for r in arcpy.da.SearchCursor(zone_fc, zone_field)]
+        summarized_zones = set(summarized[zone_field].tolist())
+        null_zones = [zone_id for zone_id in dict.fromkeys(original_zones) if zone_id not in summarized_zones]
+        fill_fields = [zone_field, 'datacoveragepct', 'ORIGINAL_COUNT', 'CELL_COUNT']
+        other_fields = [f.name for f in arcpy.ListFields(temp_entire_table)
+                        if f.editable and f.name not in fill_fields]
+        with arcpy.da.InsertCursor(temp_entire_table, fill_fields + other_fields) as i_cursor:
+            for zone_id in null_zones:
+                i_cursor.insertRow([zone_id, 0, zone_raster_dict.get(zone_id, 0), 0] + [None] * len(other_fields))
+        stats_result = DM.CopyRows(temp_entire_table, out_table)
+
+        # count the zones that got no statistics and were filled in above
+        count_diff = len(null_zones)
+
+        for item in temp_items + [temp_entire_table]:  # zone_raster only listed if converted here
+            arcpy.Delete_management(item)
 
         # cleanup
-        for item in ['temp_zonal_table', temp_entire_table, 'convertraster']:  # don't add zone_raster, orig
-            arcpy.Delete_management(item)
         arcpy.ResetEnvironments()
         env.workspace = orig_env  # hope this prevents problems using list of FCs from workspace as batch
         arcpy.CheckInExtension("Spatial")
@@ -240,120 +271,122 @@ def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_ta
         # names
         flat_zoneid = zone_field
         unflat_zoneid = zone_field.replace('flat', '')
-        zone_type = [f.type for f in arcpy.ListFields(zone_fc, flat_zoneid)][0]
+        zone_type = FIELD_TYPE_KEYWORDS[arcpy.ListFields(zone_fc, flat_zoneid)[0].type]
 
         # create table and get fields to add
-        unflat_result = DM.CreateTable('in_memory', os.path.basename(out_table))
+        unflat_result = DM.CreateTable('memory', os.path.basename(out_table))
         editable_fields = [f for f in arcpy.ListFields(intermediate_table)
                            if f.editable and f.name.lower() != flat_zoneid.lower()]
 
         # populate the new table schema
-        DM.AddField(unflat_result, unflat_zoneid, zone_type)
-        for f in editable_fields:
-            DM.AddField(unflat_result, f.name, f.type, field_length=f.length)
+        DM.AddFields(unflat_result, [[unflat_zoneid, zone_type]] +
+                     [[f.name, FIELD_TYPE_KEYWORDS[f.type], '', f.length] for f in editable_fields])
 
         # ---FIND ORIGINAL VS FLAT ZONE MAPPING-----------------------------------------------------------------
-        original_flat = defaultdict(list)
-        with arcpy.da.SearchCursor(unflat_table, [unflat_zoneid, flat_zoneid]) as cursor:
-            for row in cursor:
-                if row[1] not in original_flat[row[0]]:
-                    original_flat[row[0]].append(row[1])
+        # unique (original, flat) pairs, and original zones in the order they first appear
+        original_flat = arcpy.da.TableToNumPyArray(unflat_table, [unflat_zoneid, flat_zoneid])
+        original_flat = original_flat[np.sort(np.unique(original_flat, return_index=True)[1])]
+        zone_ids, zone_first, pair_zone = np.unique(original_flat[unflat_zoneid], return_index=True,
+                                                    return_inverse=True)
+        zone_order = np.argsort(zone_first)
+        zone_ids = zone_ids[zone_order].tolist()
+        pair_group = np.argsort(zone_order)[pair_zone]
 
         # ---DO THE CALCULATION----------------------------------------------------------------------------------
         # Use CELL_COUNT as weight for means to calculate final values for each zone.
         fixed_fields = [unflat_zoneid, 'ORIGINAL_COUNT', 'CELL_COUNT', 'datacoveragepct']
         other_field_names = [f.name for f in editable_fields if f.name not in fixed_fields]
-        i_cursor = arcpy.da.InsertCursor(unflat_result, fixed_fields + other_field_names)  # open output table cursor
-        # read component stats
-        flat_stats = {r[0]: r[1:] for r in arcpy.da.SearchCursor(
-            intermediate_table, [flat_zoneid, 'ORIGINAL_COUNT', 'CELL_COUNT', 'datacoveragepct'] + other_field_names)}
-
-        count_diff = 0
-        for zid, unflat_ids in original_flat.items():
-            # get values needed to do the math
-            valid_unflat_ids = [id for id in unflat_ids if id in flat_stats] # skip flatpolys not rasterized
-            area_vec = [flat_stats[id][0] for id in valid_unflat_ids]  # ORIGINAL_COUNT specified in 0 index earlier
-            cell_vec = [flat_stats[id][1] for id in valid_unflat_ids]
-            coverage_vec = [flat_stats[id][2] for id in valid_unflat_ids]  # datacoveragepct special handling
-            stat_vectors_by_id = [flat_stats[id][3:] for id in valid_unflat_ids]  # "the rest", list of lists
-
-            # calc the new summarized values
-            original_count = sum(filter(None, area_vec))  # None area is functionally equivalent to 0, all Nones = 0 too
-            cell_count = sum(filter(None, cell_vec))
-            if cell_count > 0:
-                weighted_coverage = sum([a * b for a, b in zip(area_vec, coverage_vec)]) / original_count
-
-                # this calculation accounts for fractional missing values, both kinds (whole zone is no data, or zone
-                # was missing some data and had data coverage % < 100). This is done by converting None to 0
-                # and by using the cell_count (count of cells with data present)
-                # instead of the full zone original_count. You have to do both or the mean will be distorted.
-                # hand-verification that this works as intended using test GIS data on was completed 2019-11-01 by NJS
-                crossprods = []
-                for i in range(0, len(valid_unflat_ids)):
-                    crossprods.append([cell_vec[i] * float(s or 0) for s in stat_vectors_by_id[i]])
-
-                weighted_stat_means = []
-                for i in range(0, len(other_field_names)):
-                    weighted_stat_means.append(sum(zip(*crossprods)[i]) / cell_count)
-            else:
-                weighted_coverage = 0
-                weighted_stat_means = [None] * len(other_field_names)
-                count_diff += 1
-
-            new_row = [zid, original_count, cell_count, weighted_coverage] + weighted_stat_means
-            i_cursor.insertRow(new_row)
-        del i_cursor
+        # read component stats. None is functionally equivalent to 0 in all of the sums below
+        stat_fields = ['ORIGINAL_COUNT', 'CELL_COUNT', 'datacoveragepct'] + other_field_names
+        flat_stats = arcpy.da.TableToNumPyArray(intermediate_table, [flat_zoneid] + stat_fields,
+                                                null_value={f: 0 for f in stat_fields})
+
+        # pair each original zone (group) with the rows of its flat zones, skipping flatpolys not rasterized
+        rasterized = np.isin(original_flat[flat_zoneid], flat_stats[flat_zoneid])
+        flat_order = np.argsort(flat_stats[flat_zoneid])
+        members = flat_order[np.searchsorted(flat_stats[flat_zoneid], original_flat[flat_zoneid][rasterized],
+                                             sorter=flat_order)]
+        groups = pair_group[rasterized]
+
+        def group_sum(values):
+            return np.bincount(groups, weights=values, minlength=len(zone_ids))
+
+        # calc the new summarized values
+        area_vec = flat_stats['ORIGINAL_COUNT'][members].astype(np.float64)
+        cell_vec = flat_stats['CELL_COUNT'][members].astype(np.float64)
+        original_count = group_sum(area_vec).astype(flat_stats['ORIGINAL_COUNT'].dtype)
+        cell_count = group_sum(cell_vec).astype(flat_stats['CELL_COUNT'].dtype)
+        has_data = cell_count > 0
+        count_diff = int((~has_data).sum())
+
+        # this calculation accounts for fractional missing values, both kinds (whole zone is no data, or zone
+        # was missing some data and had data coverage % < 100). This is done by converting None to 0
+        # and by using the cell_count (count of cells with data present)
+        # instead of the full zone original_count. You have to do both or the mean will be distorted.
+        # hand-verification that this works as intended using test GIS data on was completed 2019-11-01 by NJS
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weighted_coverage = group_sum(area_vec * flat_stats['datacoveragepct'][members]) / original_count
+            weighted_stat_means = [group_sum(cell_vec * flat_stats[f][members]) / cell_count
+                                   for f in other_field_names]
+        weighted_coverage[~has_data] = 0
+        # zones with data but no original count have no coverage to weight, write null rather than inf/nan
+        has_coverage = (original_count > 0) | ~has_data
+
+        # open output table cursor and write one row per original zone
+        with arcpy.da.InsertCursor(unflat_result, fixed_fields + other_field_names) as i_cursor:
+            for group, zid in enumerate(zone_ids):
+                if has_data[group]:
+                    stat_means = [float(means[group]) for means in weighted_stat_means]
+                else:
+                    stat_means = [None] * len(other_field_names)
+                coverage = float(weighted_coverage[group]) if has_coverage[group] else None
+                new_row = [zid, original_count[group].item(), cell_count[group].item(), coverage] + stat_means
+                i_cursor.insertRow(new_row)
 
         DM.Delete(intermediate_table)
 
         return [unflat_result, count_diff]
 
-    def rename_to_standard(table):
+    def rename_to_standard(table, out_table):
         """Construct output variable names from the rename_tag, units, and zone feature class name.
         Substitutes variable name parts from the mappings in geo_metric_provenance.csv if the variables
-        are to fit the LAGOS-US standard."""
+        are to fit the LAGOS-US standard. All fields are renamed while copying the table to out_table."""
         arcpy.AddMessage("Renaming.")
         # datacoverage just gets tag
-        new_datacov_name = '{}_datacoveragepct'.format(rename_tag)
-        lagosGIS.rename_field(table, 'datacoveragepct', new_datacov_name, deleteOld=True)
+        new_names = {'datacoveragepct': '{}_datacoveragepct'.format(rename_tag)}
 
         if not is_thematic:
             if 'elevation' in rename_tag:
-                new_mean_name = '{}_mean_{}'.format(rename_tag, units).rstrip('_')
-                lagosGIS.rename_field(table, 'MEAN', new_mean_name, deleteOld=True)
-
-                new_min_name = '{}_min_{}'.format(rename_tag, units).rstrip('_')
-                lagosGIS.rename_field(table, 'MIN', new_min_name, deleteOld=True)
-
-                new_max_name = '{}_max_{}'.format(rename_tag, units).rstrip('_')
-                lagosGIS.rename_field(table, 'MAX', new_max_name, deleteOld=True)
-
-                new_sd_name = '{}_sd_{}'.format(rename_tag, units).rstrip('_')
-                lagosGIS.rename_field(table, 'STD', new_sd_name, deleteOld=True)
+                new_names['MEAN'] = '{}_mean_{}'.format(rename_tag, units).rstrip('_')
+                new_names['MIN'] = '{}_min_{}'.format(rename_tag, units).rstrip('_')
+                new_names['MAX'] = '{}_max_{}'.format(rename_tag, units).rstrip('_')
+                new_names['STD'] = '{}_sd_{}'.format(rename_tag, units).rstrip('_')
             else:
-                new_mean_name = '{}_{}'.format(rename_tag, units).rstrip('_')  # if no units, just rename_tag
-                lagosGIS.rename_field(table, 'MEAN', new_mean_name, deleteOld=True)
+                new_names['MEAN'] = '{}_{}'.format(rename_tag, units).rstrip('_')  # if no units, just rename_tag
 
         else:
             # look up the values based on the rename tag
             geo_file = os.path.abspath('../geo_metric_provenance.csv')
-            with open(geo_file) as csv_file:
-                reader = csv.DictReader(csv_file)
-                mapping = {row['subgroup_original_code']: row['subgroup']
-                           for row in reader if row['main_feature'] and row['main_feature'] in rename_tag}
-                print(mapping)
-
-            # update them
+            mapping = dict(_load_subgroup_mapping(geo_file, os.path.getmtime(geo_file), rename_tag))
+            print(mapping)
             for old, new in mapping.items():
-                old_fname = 'VALUE_{}_pct'.format(old)
-                new_fname = '{}_{}_pct'.format(rename_tag, new)
-                if arcpy.ListFields(table, old_fname):
-                    try:
-                        # same problem with AlterField limit of 31 characters here.
-                        DM.AlterField(table, old_fname, new_fname, clear_field_alias=True)
-                    except:
-                        lagosGIS.rename_field(table, old_fname, new_fname, deleteOld=True)
-        return table
+                new_names['VALUE_{}_pct'.format(old)] = '{}_{}_pct'.format(rename_tag, new)
+
+        # update them all in one copy of the table instead of altering one field at a time
+        field_mapping = arcpy.FieldMappings()
+        field_mapping.addTable(table)
+        for old_fname, new_fname in new_names.items():
+            index = field_mapping.findFieldMapIndex(old_fname)
+            if index == -1:
+                continue
+            field_map = field_mapping.getFieldMap(index)
+            out_field = field_map.outputField
+            out_field.name = new_fname
+            out_field.aliasName = new_fname
+            field_map.outputField = out_field
+            field_mapping.replaceFieldMap(index, field_map)
+        out_workspace = os.path.dirname(out_table) or env.workspace
+        return arcpy.TableToTable_conversion(table, out_workspace, os.path.basename(out_table), '#', field_mapping)
 
     # ---RUN ------------------------------------------------------------------------------------------------------
     # Determine whether user provided "flattened zones" that need re-constitution and run stats
@@ -367,8 +400,7 @@ def calc(zone_fc, zone_field, in_value_raster, out_table, is_thematic, unflat_ta
 
     # Rename all fields to match desired output, if elected
     if rename_tag:
-        named_as_standard = rename_to_standard(named_as_original[0])
-        out_table = DM.CopyRows(named_as_standard, out_table)
+        out_table = rename_to_standard(named_as_original[0], out_table)
     else:
         out_table = DM.CopyRows(named_as_original[0], out_table)
 
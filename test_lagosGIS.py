@@ -6,10 +6,13 @@
 
 import os
 import sys
+from collections import defaultdict
 from datetime import datetime
 import arcpy
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import lagosGIS
+from lagosGIS import NHDNetwork
+from lagosGIS import _trace_kernels
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 TEST_DATA_GDB = os.path.abspath(os.path.join(os.curdir, 'TestData_0411.gdb'))
@@ -147,6 +150,106 @@ def export_to_csv(out_folder):
     lagosGIS.export_to_csv(in_table, out_folder)
 
 
+def _trace_by_dict(adjacency, start_id, stop_ids):
+    """Plain breadth-first trace over a flow dictionary, used as the reference for the NHDNetwork traces."""
+    frontier = set(adjacency.get(start_id, []))
+    traced = frontier | {start_id}
+    while frontier:
+        frontier = {id for f in frontier for id in adjacency.get(f, [])}.difference(stop_ids, traced)
+        traced.update(frontier)
+    return traced
+
+
+def _check_flowline_traces(nhd_network):
+    """Compares flowline traces for a sample of the test data flowlines to plain dictionary traces."""
+    upstream = defaultdict(list)
+    downstream = defaultdict(list)
+    with arcpy.da.SearchCursor(nhd_network.flow, [nhd_network.from_column, nhd_network.to_column]) as cursor:
+        for from_id, to_id in cursor:
+            if from_id != '0' and to_id != '0':
+                upstream[to_id].append(from_id)
+                downstream[from_id].append(to_id)
+    flowline_ids = sorted(set(upstream).union(downstream))
+    sample_ids = flowline_ids[::max(1, len(flowline_ids) // 200)]
+
+    for activate_stops in (False, True):
+        if activate_stops:
+            nhd_network.activate_10ha_lake_stops()
+        else:
+            nhd_network.deactivate_stops()
+        stop_ids = set(nhd_network.flowline_stop_ids)
+        for id in sample_ids:
+            up = set(nhd_network.trace_up_from_a_flowline(id, include_wb_permids=False))
+            down = set(nhd_network.trace_down_from_a_flowline(id, include_wb_permids=False))
+            assert up == _trace_by_dict(upstream, id, stop_ids), "Upstream trace differs for {}".format(id)
+            assert down == _trace_by_dict(downstream, id, stop_ids), "Downstream trace differs for {}".format(id)
+    nhd_network.deactivate_stops()
+
+
+def nhd_network_trace():
+    """Checks the flowline traces with the numba kernel, if installed, and with the NumPy fallback."""
+    have_numba = _trace_kernels.HAVE_NUMBA
+    try:
+        for use_numba in sorted({False, have_numba}):
+            _trace_kernels.HAVE_NUMBA = use_numba
+            _check_flowline_traces(NHDNetwork.NHDNetwork(TEST_DATA_GDB))
+    finally:
+        _trace_kernels.HAVE_NUMBA = have_numba
+
+
+def _interlake_erasable_by_set_math(nhd_network):
+    """
+    The original set-based define_interlake_erasable, kept as the reference for its regression check. Uses only
+    single-start traces so that it does not share the batch tracing code it is checking.
+    """
+    focal_lakes = list(nhd_network.waterbody_start_ids)
+    nhd_network.deactivate_stops()
+    lake_upstream_traces = {k: set(nhd_network.trace_up_from_a_waterbody(k)) for k in focal_lakes}
+    lake_downstream_traces = {k: set(nhd_network.trace_down_from_a_waterbody(k)) for k in focal_lakes}
+    nhd_network.activate_10ha_lake_stops()
+    lake_interlake_traces = {k: set(nhd_network.trace_up_from_a_waterbody(k)) for k in focal_lakes}
+    tenha_ids = list(nhd_network.tenha_waterbody_ids)
+    nhd_network.deactivate_stops()
+
+    tenha_conn = {id: nhd_network.classify_waterbody_connectivity(id) for id in tenha_ids}
+    tenha_nets_full = {k: set(nhd_network.trace_up_from_a_waterbody(k)) for k in tenha_ids}
+    if not nhd_network.outlets:
+        nhd_network.identify_subregion_outlets()
+    on_network = {id for outlet in nhd_network.outlets for id in nhd_network.trace_up_from_a_flowline(outlet)}
+    tenha_terminal = {k: v.difference(on_network) for k, v in tenha_nets_full.items()
+                      if tenha_conn[k] in ('Terminal', 'TerminalLk')}
+    tenha_drainage = {k: v for k, v in tenha_nets_full.items()
+                      if tenha_conn[k] in ('Headwater', 'Drainage', 'DrainageLk')}
+    isolated = {k for k in tenha_nets_full if tenha_conn[k] == 'Isolated'}
+
+    erasable_dict = {}
+    for lake_id in focal_lakes:
+        focal_upstream = lake_upstream_traces[lake_id]
+        if len(focal_upstream) < 2:
+            erasable_dict[lake_id] = set()
+            continue
+        eligible = [v for k, v in tenha_terminal.items() if k not in lake_downstream_traces[lake_id]]
+        eligible.extend(v for k, v in tenha_drainage.items() if k in focal_upstream)
+        erasable = set(isolated)
+        for net in eligible:
+            erasable.update(net.difference(lake_interlake_traces[lake_id]))
+        erasable_dict[lake_id] = erasable
+    return erasable_dict
+
+
+def interlake_erasable():
+    """Checks define_interlake_erasable against the set-based reference for every lake in the test data."""
+    nhd_network = NHDNetwork.NHDNetwork(TEST_DATA_GDB)
+    nhd_network.define_lakes()
+    lake_ids = list(nhd_network.lakes_areas)
+    nhd_network.set_start_ids(lake_ids)
+    erasable = nhd_network.define_interlake_erasable()
+    nhd_network.set_start_ids(lake_ids)
+    expected = _interlake_erasable_by_set_math(nhd_network)
+    mismatched = [k for k in lake_ids if set(erasable[k]) != expected[k]]
+    assert not mismatched, "define_interlake_erasable differs for lakes {}".format(mismatched[:10])
+
+
 def test_all(out_gdb):
     """
     Sets up tests for many tests in LAGOS GIS Toolbox using the test data included and saves the outputs to a common
@@ -159,6 +262,10 @@ def test_all(out_gdb):
         arcpy.CreateFileGDB_management(os.path.dirname(out_gdb), os.path.basename(out_gdb))
     dt_prefix = datetime.now().strftime("%b%d_%H%M")
     arcpy.AddMessage("All test files will start with date-time prefix {}".format(dt_prefix))
+    arcpy.AddMessage('\n' + 'TESTING: nhd_network_trace()')
+    nhd_network_trace()
+    arcpy.AddMessage('\n' + 'TESTING: interlake_erasable()')
+    interlake_erasable()
     for method in __all__:
         if method == 'rasterize_zones':
             eval_str = '''{}('{}')'''.format(method, out_gdb).replace("\\", "/")